@@ -5,26 +5,242 @@ Created on Thu Oct  1 08:38:16 2020
 
 @author: Jürgen Probst
 """
-import pandas as pd
-import jinja2
-import weasyprint
+# The heavy modules (pandas, jinja2, weasyprint, babel) are imported
+# only where they are first needed, so the command line usage and the
+# GUI window show up quickly.
 import os.path
 import sys, os
+import re
+import pathlib
+import urllib.parse
+import urllib.request
+import collections
+import functools
+import itertools
+import hashlib
+import contextlib
+import time
+import json
+import pickle
+import csv
+import shutil
+import tempfile
+import io
+import zipfile
+import tarfile
+import threading
+import queue
 import locale
+import argparse
+import asyncio
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, wait,
+    FIRST_COMPLETED)
 #import xlrd # just as a reminder that we need to install this package
-import babel
-# On a tested windows machine, babel wouldn't work because there
-# was no current locale set. Apparently, there is no `LC_NUMERIC`
-# environment variable, so the babel default locale of
-# `babel.default_locale('LC_NUMERIC')` returns `None`
-# Solution: Set the environment variable 'LC_ALL' since it will
-# also help with the non-existing 'LC_TIME' for example:
-mylocale = locale.getlocale()[0]
-if babel.default_locale('LC_NUMERIC') is None:
-    if os.getenv('LC_ALL') is None:
-        os.environ['LC_ALL'] = mylocale
-# it is important to import these after the fix made above:
-import babel.numbers, babel.dates
+
+
+def _import_babel():
+    """Import and return babel, including babel.numbers and babel.dates."""
+    import babel
+    if 'babel.numbers' not in sys.modules:
+        # On a tested windows machine, babel wouldn't work because there
+        # was no current locale set. Apparently, there is no `LC_NUMERIC`
+        # environment variable, so the babel default locale of
+        # `babel.default_locale('LC_NUMERIC')` returns `None`
+        # Solution: Set the environment variable 'LC_ALL' since it will
+        # also help with the non-existing 'LC_TIME' for example:
+        mylocale = locale.getlocale()[0]
+        if babel.default_locale('LC_NUMERIC') is None:
+            if os.getenv('LC_ALL') is None and mylocale is not None:
+                os.environ['LC_ALL'] = mylocale
+    # it is important to import these after the fix made above:
+    import babel.numbers, babel.dates
+    return babel
+
+def _get_font_configuration():
+    try:
+        from weasyprint.text.fonts import FontConfiguration
+    except ImportError:
+        # WeasyPrint < 53
+        from weasyprint.fonts import FontConfiguration
+    return FontConfiguration()
+
+
+class Formatters(object):
+
+    # names of the date formats of a locale:
+    date_format_names = ('full', 'long', 'medium', 'short')
+
+    def __init__(self, locale=None, cache_size=4096):
+        """Create the formatters used in the templates, based on
+        babel.numbers and babel.dates.
+
+        The locale and the format patterns are resolved only once, and
+        the results for recurring values are cached.
+
+        :param locale: None or locale identifier, e.g. 'de_DE' or 'en_US';
+            If None (default), the locale will be taken from the
+            `LC_NUMERIC` or `LC_TIME` environment variables on your
+            system, for numeric or date values, respectively.
+        :param cache_size: int;
+            Maximum number of formatted values to keep.
+
+        """
+        self.locale = locale
+        self.cache_size = cache_size
+        # babel is imported on first use, see `_setup`:
+        self.babel = None
+
+    def _setup(self):
+        self.babel = babel = _import_babel()
+        if self.locale is None:
+            numeric_locale = babel.default_locale('LC_NUMERIC')
+            time_locale = babel.default_locale('LC_TIME')
+        else:
+            numeric_locale = time_locale = self.locale
+        self.numeric_locale = babel.Locale.parse(
+            numeric_locale or 'en_US_POSIX')
+        self.time_locale = babel.Locale.parse(time_locale or 'en_US_POSIX')
+        # parsed patterns by (kind, format string, locale):
+        self._patterns = {}
+        # babel.Locale by `locale` argument of the formatters:
+        self._locales = {}
+        self._cached_call = functools.lru_cache(maxsize=self.cache_size)(
+            self._call)
+
+    def get_locales(self):
+        """Return the tuple of babel.Locale (numeric, time) used by the
+        formatters if no locale is given to them.
+        """
+        if self.babel is None:
+            self._setup()
+        return self.numeric_locale, self.time_locale
+
+    def get_filters(self):
+        """Return a dictionary of the formatters, to be used as filters
+        in a jinja2 environment.
+        """
+        return {
+            'format_currency': self.format_currency,
+            'format_percent': self.format_percent,
+            'format_decimal': self.format_decimal,
+            'format_amount': self.format_amount,
+            'format_date': self.format_date,
+            'format_datetime': self.format_datetime,
+        }
+
+    @staticmethod
+    def _call(func, value_type, value, args, kwargs):
+        return func(value, *args, **dict(kwargs))
+
+    def _format(self, func, value, args, kwargs):
+        key = (func, type(value), value, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable value or argument:
+            return func(value, *args, **kwargs)
+        return self._cached_call(*key)
+
+    def _get_locale(self, locale, default):
+        """Return the babel.Locale for the `locale` argument of a
+        formatter, or `default` if it is None.
+        """
+        if locale is None:
+            return default
+        parsed = self._locales.get(locale)
+        if parsed is None:
+            parsed = self.babel.Locale.parse(locale)
+            self._locales[locale] = parsed
+        return parsed
+
+    def _get_number_pattern(self, format):
+        if not isinstance(format, str):
+            return format
+        pattern = self._patterns.get(('number', format))
+        if pattern is None:
+            pattern = self.babel.numbers.parse_pattern(format)
+            self._patterns[('number', format)] = pattern
+        return pattern
+
+    def _get_date_pattern(self, format, locale, named=True):
+        if not isinstance(format, str):
+            return format
+        if format in self.date_format_names and not named:
+            # leave it to babel, e.g. for datetimes:
+            return format
+        # the named formats depend on the locale:
+        key = ('date', format,
+               locale if format in self.date_format_names else None)
+        pattern = self._patterns.get(key)
+        if pattern is None:
+            if format in self.date_format_names:
+                pattern = self.babel.dates.get_date_format(
+                    format, locale=locale)
+            else:
+                pattern = self.babel.dates.parse_pattern(format)
+            self._patterns[key] = pattern
+        return pattern
+
+    # The formatters take the same arguments as the babel functions, so
+    # the locale can be given positionally or as keyword argument.
+
+    def format_currency(self, number, currency, format=None, locale=None,
+                        *args, **kwargs):
+        if self.babel is None:
+            self._setup()
+        locale = self._get_locale(locale, self.numeric_locale)
+        return self._format(
+            self.babel.numbers.format_currency, number,
+            (currency, self._get_number_pattern(format), locale) + args,
+            kwargs)
+
+    def format_percent(self, number, format=None, locale=None,
+                       *args, **kwargs):
+        if self.babel is None:
+            self._setup()
+        locale = self._get_locale(locale, self.numeric_locale)
+        return self._format(
+            self.babel.numbers.format_percent, number,
+            (self._get_number_pattern(format), locale) + args, kwargs)
+
+    def format_decimal(self, number, format=None, locale=None,
+                       *args, **kwargs):
+        if self.babel is None:
+            self._setup()
+        locale = self._get_locale(locale, self.numeric_locale)
+        return self._format(
+            self.babel.numbers.format_decimal, number,
+            (self._get_number_pattern(format), locale) + args, kwargs)
+
+    def format_amount(self, number, locale=None):
+        return self.format_decimal(number, format=u'#,##0.00', locale=locale)
+
+    def format_date(self, date=None, format='medium', locale=None):
+        if self.babel is None:
+            self._setup()
+        locale = self._get_locale(locale, self.time_locale)
+        if date is None:
+            # today, must not be cached:
+            return self.babel.dates.format_date(
+                format=format, locale=locale)
+        return self._format(
+            self.babel.dates.format_date, date,
+            (self._get_date_pattern(format, locale), locale), {})
+
+    def format_datetime(self, datetime=None, format='medium', tzinfo=None,
+                        locale=None):
+        if self.babel is None:
+            self._setup()
+        locale = self._get_locale(locale, self.time_locale)
+        if datetime is None:
+            # now, must not be cached:
+            return self.babel.dates.format_datetime(
+                format=format, tzinfo=tzinfo, locale=locale)
+        return self._format(
+            self.babel.dates.format_datetime, datetime,
+            (self._get_date_pattern(format, locale, named=False), tzinfo,
+             locale), {})
 
 
 # Jinja2 documentation: https://jinja.palletsprojects.com/en/2.11.x/
@@ -38,89 +254,1865 @@ import babel.numbers, babel.dates
 # https://weasyprint.readthedocs.io/en/stable/tips-tricks.html
 # Optional whitespace escaping: https://svn.python.org/projects/external/Jinja-1.1/docs/build/escaping.html
 
+# WeasyPrint stylesheets: https://weasyprint.readthedocs.io/en/stable/tutorial.html#stylesheet-origins
+# https://weasyprint.readthedocs.io/en/stable/tutorial.html#fonts
+
+# regular expressions to find the stylesheets in a template:
+_style_re = re.compile(r'<style\b([^>]*)>(.*?)</style\s*>', re.I | re.S)
+_link_re = re.compile(r'<link\b[^>]*>', re.I)
+_stylesheet_rel_re = re.compile(r'\brel\s*=\s*["\']?stylesheet\b', re.I)
+_href_re = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.I)
+_media_re = re.compile(r'\bmedia\s*=', re.I)
+_jinja_syntax_re = re.compile(r'{{|{%|{#')
+_important_re = re.compile(r'!\s*important|@import', re.I)
+# the content of the body of a filled template:
+_body_re = re.compile(r'<body\b[^>]*>(.*)</body\s*>', re.I | re.S)
+# references to other files in templates and stylesheets:
+_asset_re = re.compile(
+    r'''\b(?:src|href)\s*=\s*["']([^"'{}]+)["']'''
+    r'''|\burl\(\s*["']?([^"'{}()]+?)["']?\s*\)''', re.I)
+# id of the elements wrapping each row in a batched document:
+_batch_anchor = 'formletter-batch-row-%i'
+
+# the strings pandas reads as missing values by default (see the
+# `na_values` parameter of `pandas.read_csv`):
+_na_values = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null'])
+# lines of a csv file with only missing values, or no values at all:
+_na_field = b'(?:%s)?' % b'|'.join(
+    re.escape(value.encode('ascii'))
+    for value in sorted(_na_values, key=len, reverse=True) if value)
+_empty_line_re = re.compile(_na_field + b'(?:,' + _na_field + b')*\r?\n?')
+_blank_line_re = re.compile(br'\s*')
+
+
+class DataSource(object):
+
+    # file name extensions (lower case) and URI scheme handled by a
+    # subclass, see `get_data_source`:
+    extensions = ()
+    scheme = None
+    # whether the parsed table is worth keeping in a `DataCache`, i.e.
+    # parsing it is slow and it is a local file:
+    cacheable = False
+
+    def __init__(self, location):
+        """Create a reader for the table data in `location`, usually a
+        file name. Subclasses implement the different formats and are
+        chosen by `get_data_source`; new ones can be added with
+        `register_data_source`.
+
+        All methods taking a `usecols` parameter accept None for all
+        columns, or a function which is called with each column name
+        and returns True for the columns to load.
+        """
+        self.location = location
+
+    @classmethod
+    def matches(cls, location):
+        """Return True if this class can read `location`."""
+        if cls.scheme is not None and location.startswith(cls.scheme + ':'):
+            return True
+        return location.lower().endswith(cls.extensions)
+
+    def get_sheet_names(self):
+        """Return the list of names of the sheets (or tables) in the
+        source, or None if it only has one.
+        """
+        return None
+
+    def get_sheet_name(self, sheet_name=None):
+        """Return the sheet name to use for `sheet_name`: the first sheet
+        if it is None, or None if the source has no sheets.
+        """
+        sheet_names = self.get_sheet_names()
+        if sheet_names is None:
+            return None
+        if sheet_name is None:
+            return sheet_names[0]
+        if sheet_name not in sheet_names:
+            raise ValueError("sheet name '%s' not in file" % sheet_name)
+        return sheet_name
+
+    def read(self, sheet_name=None, usecols=None):
+        """Return the whole table as pandas.DataFrame."""
+        raise NotImplementedError
+
+    def read_columns(self, sheet_name=None):
+        """Return the list of column names, without loading the whole
+        table if possible.
+        """
+        return list(self.read(sheet_name).columns)
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        """Yield the table as DataFrames of up to `chunksize` rows,
+        without loading the whole table if possible.
+        """
+        data = self.read(sheet_name, usecols)
+        for start in range(0, data.shape[0], chunksize):
+            yield data.iloc[start:start + chunksize]
+
+    # Empty rows (where all values are missing) are dropped from the
+    # data. Whether a row is empty must not depend on the columns loaded,
+    # since that would change the row numbers. So all columns are read,
+    # unless a subclass can find the empty rows cheaply, without
+    # parsing all values.
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        """Return the table as pandas.DataFrame like `read`, without the
+        rows which are empty in all columns of the source.
+        """
+        return _drop_empty_rows(self.read(sheet_name), usecols)
+
+    def iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None):
+        """Yield the table as DataFrames like `iter_chunks`, without the
+        rows which are empty in all columns of the source. The chunks
+        may be shorter than `chunksize`.
+
+        All chunks have the same column types, so the values don't depend
+        on the chunk they are in. These are combined from the types of
+        the single chunks like pandas does for a whole column: integers
+        become floats if there are missing values, and a column with any
+        text becomes a text column. This takes an extra pass over the
+        data (but not more memory).
+        """
+        dtypes = {}
+        for chunk in self._iter_nonempty_chunks(
+                chunksize, sheet_name, usecols):
+            for column, dtype in chunk.dtypes.items():
+                dtypes[column] = _get_common_dtype(
+                    dtypes.get(column, dtype), dtype)
+        for chunk in self._iter_nonempty_chunks(
+                chunksize, sheet_name, usecols, dtypes):
+            changed = {column: dtype for column, dtype in dtypes.items()
+                       if chunk[column].dtype != dtype}
+            yield chunk.astype(changed) if changed else chunk
+
+    def _iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None,
+                              dtypes=None):
+        # `dtypes` is a dict of the column types the chunks will be
+        # converted to, for sources which can use them when parsing:
+        for chunk in self.iter_chunks(chunksize, sheet_name):
+            yield _drop_empty_rows(chunk, usecols)
+
+
+class CSVSource(DataSource):
+
+    extensions = ('.csv', '.txt')
+    cacheable = True
+
+    def _read_csv(self, **kwargs):
+        import pandas as pd
+        try:
+            return pd.read_csv(self.location, **kwargs)
+        except pd.errors.ParserError as pe:
+            print("unknown data file format")
+            raise pe
+
+    def read(self, sheet_name=None, usecols=None):
+        return self._read_csv(usecols=usecols)
+
+    def read_columns(self, sheet_name=None):
+        return list(self._read_csv(nrows=0).columns)
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        return self._read_csv(chunksize=chunksize, usecols=usecols)
+
+    def _iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None,
+                              dtypes=None):
+        # parse the values as the given types, e.g. numbers in a text
+        # column as they are written in the file:
+        for chunk in self._read_csv(chunksize=chunksize, dtype=dtypes):
+            yield _drop_empty_rows(chunk, usecols)
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        if usecols is not None:
+            # only parse the used columns:
+            empty = self._find_empty_rows()
+            if empty is not None:
+                data = self._read_csv(usecols=usecols)
+                if len(empty) == data.shape[0]:
+                    return data[[not row_empty for row_empty in empty]]
+        return super().read_nonempty(sheet_name, usecols)
+
+    def _find_empty_rows(self):
+        """Return a list telling for each row of the file whether all its
+        values are missing, or None if that can't be found out. Only the
+        lines containing quotes are split into values, the others are
+        matched as a whole, which is much faster than parsing them.
+        """
+        empty = []
+        # the lines of a record with a quoted line break:
+        record = b''
+        try:
+            with open(self.location, 'rb') as f:
+                for line in f:
+                    line = record + line
+                    if b'"' in line:
+                        if line.count(b'"') % 2:
+                            record = line
+                            continue
+                        record = b''
+                        values = next(csv.reader([line.decode('utf-8')]))
+                        empty.append(all(value in _na_values
+                                         for value in values))
+                    elif not _blank_line_re.fullmatch(line):
+                        empty.append(bool(_empty_line_re.fullmatch(line)))
+        except (OSError, UnicodeDecodeError, csv.Error):
+            # e.g. an URL or another encoding
+            return None
+        # without the header:
+        return empty[1:]
+
+
+class ExcelSource(DataSource):
+
+    extensions = ('.xlsx', '.xlsm', '.xls', '.ods')
+    cacheable = True
+
+    def __init__(self, location):
+        super().__init__(location)
+        # pandas.ExcelFile, opened on first use:
+        self._book = None
+
+    def _get_book(self):
+        if self._book is None:
+            import pandas as pd
+            self._book = pd.ExcelFile(self.location)
+        return self._book
+
+    def get_sheet_names(self):
+        if self._book is None and self.location.lower().endswith('.xlsx'):
+            # much faster than opening the whole workbook:
+            import openpyxl
+            wb = openpyxl.load_workbook(self.location, read_only=True)
+            try:
+                return wb.sheetnames
+            finally:
+                wb.close()
+        return self._get_book().sheet_names
+
+    def read(self, sheet_name=None, usecols=None):
+        book = self._get_book()
+        return book.parse(self.get_sheet_name(sheet_name), usecols=usecols)
+
+    def _iter_xlsx_rows(self, sheet_name, values_only=True):
+        import openpyxl
+        wb = openpyxl.load_workbook(
+            self.location, read_only=True, data_only=True)
+        try:
+            yield from wb[self.get_sheet_name(sheet_name)].iter_rows(
+                values_only=values_only)
+        finally:
+            wb.close()
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        # .xlsx files are read cell by cell in one pass, keeping only the
+        # values of the used columns; other formats are read completely:
+        if usecols is None or not self.location.lower().endswith('.xlsx'):
+            return super().read_nonempty(sheet_name, usecols)
+        import pandas as pd
+        from pandas.io.parsers import TextParser
+        rows = self._iter_xlsx_rows(sheet_name, values_only=False)
+        try:
+            header = _get_column_names(cell.value for cell in next(rows))
+            indexes = [i for i, column in enumerate(header)
+                       if usecols(column)]
+            data = [[header[i] for i in indexes]]
+            for row in rows:
+                values = [_convert_xlsx_cell(cell) for cell in row]
+                if all(_is_missing(value) for value in values):
+                    continue
+                data.append([values[i] if i < len(values) else ""
+                             for i in indexes])
+        finally:
+            rows.close()
+        if not indexes:
+            return pd.DataFrame(index=pd.RangeIndex(len(data) - 1))
+        # the same conversion of the values as in `pandas.read_excel`:
+        return TextParser(data, header=0, skip_blank_lines=False).read()
+
+    def read_columns(self, sheet_name=None):
+        if not self.location.lower().endswith('.xlsx'):
+            return super().read_columns(sheet_name)
+        rows = self._iter_xlsx_rows(sheet_name)
+        try:
+            return _get_column_names(next(rows))
+        finally:
+            rows.close()
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        if not self.location.lower().endswith('.xlsx'):
+            yield from super().iter_chunks(chunksize, sheet_name, usecols)
+            return
+        import pandas as pd
+        rows = self._iter_xlsx_rows(sheet_name)
+        try:
+            header = _get_column_names(next(rows))
+            indexes = [i for i, column in enumerate(header)
+                       if usecols is None or usecols(column)]
+            header = [header[i] for i in indexes]
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if not chunk:
+                    break
+                yield pd.DataFrame(
+                    [[row[i] if i < len(row) else None for i in indexes]
+                     for row in chunk],
+                    columns=header)
+        finally:
+            rows.close()
+
+
+class ParquetSource(DataSource):
+
+    extensions = ('.parquet', '.pq')
+
+    def _open(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(self.location, memory_map=True)
+
+    def read_columns(self, sheet_name=None):
+        return self._open().schema_arrow.names
+
+    def _get_columns(self, usecols):
+        if usecols is None:
+            return None
+        return [column for column in self.read_columns() if usecols(column)]
+
+    def read(self, sheet_name=None, usecols=None):
+        return self._open().read(
+            columns=self._get_columns(usecols)).to_pandas()
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        for batch in self._open().iter_batches(
+                batch_size=chunksize, columns=self._get_columns(usecols)):
+            yield batch.to_pandas()
+
+    def _has_empty_rows(self):
+        # a column without missing values according to the statistics
+        # (and without NaN, which need not be stored as null) means there
+        # are no empty rows:
+        import pyarrow
+        metadata = self._open().metadata
+        schema = self._open().schema_arrow
+        for i, field in enumerate(schema):
+            if pyarrow.types.is_floating(field.type):
+                continue
+            statistics = [metadata.row_group(j).column(i).statistics
+                          for j in range(metadata.num_row_groups)]
+            if all(stat is not None and stat.has_null_count
+                   and stat.null_count == 0 for stat in statistics):
+                return False
+        return True
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        if usecols is not None and not self._has_empty_rows():
+            return self.read(sheet_name, usecols)
+        return super().read_nonempty(sheet_name, usecols)
+
+    def _iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None,
+                              dtypes=None):
+        if usecols is not None and not self._has_empty_rows():
+            return self.iter_chunks(chunksize, sheet_name, usecols)
+        return super()._iter_nonempty_chunks(chunksize, sheet_name, usecols)
+
+
+class FeatherSource(DataSource):
+
+    extensions = ('.feather', '.arrow')
+
+    def _read_table(self, usecols=None):
+        import pyarrow.feather
+        # memory mapped, so only the used columns are actually read:
+        table = pyarrow.feather.read_table(self.location, memory_map=True)
+        if usecols is not None:
+            table = table.select(
+                [column for column in table.column_names if usecols(column)])
+        return table
+
+    def read_columns(self, sheet_name=None):
+        return self._read_table().column_names
+
+    def read(self, sheet_name=None, usecols=None):
+        return self._read_table(usecols).to_pandas()
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        for batch in self._read_table(usecols).to_batches(chunksize):
+            yield batch.to_pandas()
+
+    def _has_empty_rows(self):
+        # the null counts are known without reading the data; NaN need
+        # not be stored as null, so floating point columns don't count:
+        import pyarrow
+        table = self._read_table()
+        return not any(
+            column.null_count == 0
+            and not pyarrow.types.is_floating(column.type)
+            for column in table.columns)
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        if usecols is not None and not self._has_empty_rows():
+            return self.read(sheet_name, usecols)
+        return super().read_nonempty(sheet_name, usecols)
+
+    def _iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None,
+                              dtypes=None):
+        if usecols is not None and not self._has_empty_rows():
+            return self.iter_chunks(chunksize, sheet_name, usecols)
+        return super()._iter_nonempty_chunks(chunksize, sheet_name, usecols)
+
+
+class SQLiteSource(DataSource):
+
+    extensions = ('.db', '.sqlite', '.sqlite3')
+    scheme = 'sqlite'
+
+    def __init__(self, location):
+        """Create a reader for a table or query of an SQLite database.
+
+        :param location: string;
+            The database file name, or an URI like
+            'sqlite:///relative/path.db' or 'sqlite:////absolute/path.db',
+            optionally followed by '?table=NAME' or '?query=SELECT ...'
+            (URL-encoded). Else, the tables and views are the sheets.
+        """
+        super().__init__(location)
+        self.query = None
+        self.table = None
+        if location.startswith('sqlite:'):
+            url = urllib.parse.urlsplit(location)
+            self.file_name = urllib.parse.unquote(url.path[1:])
+            params = urllib.parse.parse_qs(url.query)
+            self.query = params.get('query', [None])[0]
+            self.table = params.get('table', [None])[0]
+        else:
+            self.file_name = location
+
+    def _connect(self):
+        import sqlite3
+        if not os.path.isfile(self.file_name):
+            # (sqlite3 would create an empty database)
+            raise FileNotFoundError(self.file_name)
+        return contextlib.closing(sqlite3.connect(
+            pathlib.Path(os.path.abspath(self.file_name)).as_uri() + '?mode=ro',
+            uri=True))
+
+    def get_sheet_names(self):
+        if self.query is not None or self.table is not None:
+            return None
+        with self._connect() as con:
+            return [name for name, in con.execute(
+                "SELECT name FROM sqlite_master WHERE type IN "
+                "('table', 'view') AND name NOT LIKE 'sqlite_%' "
+                "ORDER BY rowid")]
+
+    def _get_query(self, sheet_name):
+        if self.query is not None:
+            return self.query
+        table = self.table or self.get_sheet_name(sheet_name)
+        return 'SELECT * FROM "%s"' % table.replace('"', '""')
+
+    def _get_projected_query(self, sheet_name, usecols, nonempty=False):
+        query = self._get_query(sheet_name)
+        if usecols is None and not nonempty:
+            return query
+        all_columns = self.read_columns(sheet_name)
+        columns = [column for column in all_columns
+                   if usecols is None or usecols(column)]
+        query = 'SELECT %s FROM (%s)' % (
+            ', '.join(_quote_sql(column) for column in columns), query)
+        if nonempty:
+            # the database checks all columns, also the ones not loaded:
+            query += ' WHERE NOT (%s)' % ' AND '.join(
+                '%s IS NULL' % _quote_sql(column) for column in all_columns)
+        return query
+
+    def read_columns(self, sheet_name=None):
+        with self._connect() as con:
+            cursor = con.execute(
+                'SELECT * FROM (%s) LIMIT 0' % self._get_query(sheet_name))
+            return [description[0] for description in cursor.description]
+
+    def read(self, sheet_name=None, usecols=None):
+        import pandas as pd
+        with self._connect() as con:
+            return pd.read_sql_query(
+                self._get_projected_query(sheet_name, usecols), con)
+
+    def iter_chunks(self, chunksize, sheet_name=None, usecols=None):
+        import pandas as pd
+        with self._connect() as con:
+            yield from pd.read_sql_query(
+                self._get_projected_query(sheet_name, usecols), con,
+                chunksize=chunksize)
+
+    def read_nonempty(self, sheet_name=None, usecols=None):
+        import pandas as pd
+        with self._connect() as con:
+            return pd.read_sql_query(
+                self._get_projected_query(sheet_name, usecols, True), con)
+
+    def _iter_nonempty_chunks(self, chunksize, sheet_name=None, usecols=None,
+                              dtypes=None):
+        import pandas as pd
+        with self._connect() as con:
+            yield from pd.read_sql_query(
+                self._get_projected_query(sheet_name, usecols, True), con,
+                chunksize=chunksize)
+
+
+def _quote_sql(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _get_common_dtype(dtype, other):
+    """Return the type of a column whose parts have the types `dtype` and
+    `other`, see `DataSource.iter_nonempty_chunks`.
+    """
+    import numpy as np
+    import pandas as pd
+    if dtype == other:
+        return dtype
+    is_bool = pd.api.types.is_bool_dtype
+    is_number = pd.api.types.is_numeric_dtype
+    if is_bool(dtype) or is_bool(other):
+        return np.dtype(object)
+    if is_number(dtype) and is_number(other):
+        try:
+            return np.result_type(dtype, other)
+        except TypeError:
+            # e.g. pandas extension types
+            return np.dtype(object)
+    if is_number(dtype):
+        return other
+    if is_number(other):
+        return dtype
+    return np.dtype(object)
+
+
+def _convert_xlsx_cell(cell):
+    """Return the value of an openpyxl cell as `pandas.read_excel` passes
+    it on to be parsed.
+    """
+    import numpy as np
+    if cell.value is None:
+        return ""
+    if cell.data_type == 'e':
+        # error, e.g. #DIV/0!
+        return np.nan
+    if cell.data_type == 'n':
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    return cell.value
+
+
+def _is_missing(value):
+    """Return True if pandas reads `value` as missing."""
+    if isinstance(value, str):
+        return value in _na_values
+    return isinstance(value, float) and value != value
+
+
+def _drop_empty_rows(data, usecols=None):
+    """Return `data` without the rows where all values are missing, and
+    only with the columns selected by `usecols` (None for all).
+    """
+    data = data.dropna(axis=0, how='all')
+    if usecols is not None:
+        data = data[[column for column in data.columns if usecols(column)]]
+    return data
+
+
+# data source classes, in the order they are tried, see `get_data_source`:
+_data_sources = [ExcelSource, ParquetSource, FeatherSource, SQLiteSource,
+                 CSVSource]
+
+def register_data_source(source_class):
+    """Add a subclass of `DataSource`, which will be tried first by
+    `get_data_source`.
+    """
+    _data_sources.insert(0, source_class)
+
+def get_data_source(location):
+    """Return a `DataSource` reading `location`, a file name or URI,
+    chosen by its extension or scheme. Unknown ones are read as CSV.
+    """
+    location = os.fspath(location)
+    for source_class in _data_sources:
+        if source_class.matches(location):
+            return source_class(location)
+    return CSVSource(location)
+
+
+def _get_cache_dir():
+    """Return the user's cache directory for FormLetter."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = (os.environ.get('XDG_CACHE_HOME')
+                or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'formletter')
+
+
+class DataCache(object):
+
+    def __init__(self, directory=None, max_entries=32):
+        """Create an on-disk cache of parsed data sheets, so files which
+        are slow to parse (e.g. big Excel workbooks) need to be parsed
+        only once as long as they do not change.
+
+        The sheets are stored as they are returned by `load_data`, i.e.
+        cleaned, as pickle files, keyed by the absolute file name, its
+        size and modification time, and the sheet name. Only sources
+        with a true `cacheable` attribute are cached.
+
+        :param directory: None or string;
+            Cache directory. If None (default), a directory 'formletter'
+            in the user's cache directory is used.
+        :param max_entries: int;
+            Maximum number of cached sheets. If exceeded, the least
+            recently stored ones are removed.
+
+        """
+        self.directory = directory or _get_cache_dir()
+        self.max_entries = max_entries
+
+    def _get_prefix(self, path, sheet_name, columns=None):
+        key = json.dumps([path, sheet_name] + (
+            [] if columns is None else [list(columns)]))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def _get_file_name(self, source, sheet_name, columns=None):
+        """Return the cache file name for the sheet (only the `columns`,
+        unless None), or None if the source is not cached.
+        """
+        if not source.cacheable:
+            return None
+        import pandas as pd
+        path = os.path.abspath(source.location)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # the pandas version is part of the key, since pickles need not
+        # be readable by other versions:
+        key = json.dumps([stat.st_size, stat.st_mtime_ns, pd.__version__])
+        return os.path.join(self.directory, '%s-%s.pickle' % (
+            self._get_prefix(path, sheet_name, columns),
+            hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]))
+
+    def get(self, source, sheet_name=None, columns=None):
+        """Return the cached DataFrame of the sheet of `source` (a
+        `DataSource`), or None if it is not in the cache or the file
+        changed since. If `columns`, a list of column names as in the
+        source, is given, only these are returned, cached on their own
+        or taken from the cached whole sheet.
+        """
+        if columns is not None:
+            data = self.get(source, sheet_name)
+            with contextlib.suppress(KeyError):
+                if data is not None:
+                    return data[_rename_columns(columns, warn=False)]
+        file_name = self._get_file_name(source, sheet_name, columns)
+        if file_name is None or not os.path.exists(file_name):
+            return None
+        try:
+            with open(file_name, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print('WARNING: could not read cached data %s: %s' % (
+                file_name, e))
+            with contextlib.suppress(OSError):
+                os.remove(file_name)
+            return None
+
+    def put(self, source, sheet_name, data, columns=None):
+        """Store `data`, the DataFrame of the sheet of `source` (only the
+        `columns`, unless None), replacing the entry of an older version
+        of the file.
+        """
+        file_name = self._get_file_name(source, sheet_name, columns)
+        if file_name is None:
+            return
+        prefix = os.path.basename(file_name).split('-')[0]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_name = '%s.%x.tmp' % (file_name, threading.get_ident())
+            with open(temp_name, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_name, file_name)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.pickle'):
+                    continue
+                if (entry.name.startswith(prefix + '-')
+                        and entry.path != file_name):
+                    os.remove(entry.path)
+                else:
+                    entries.append((entry.stat().st_mtime, entry.path))
+            entries.sort()
+            for mtime, path in entries[:-self.max_entries]:
+                os.remove(path)
+        except OSError as e:
+            print('WARNING: could not cache data in %s: %s' % (
+                self.directory, e))
+
+    def clear(self):
+        """Remove all cached sheets."""
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pickle'):
+                    os.remove(entry.path)
+
+
+def _rename_columns(columns, warn=True):
+    """Return the list of `columns` with spaces in the names replaced by
+    underscores, so they can be used in templates.
+    """
+    columns = list(columns)
+    for i, column in enumerate(columns):
+        if " " in column:
+            new_name = column.replace(" ", "_")
+            if warn:
+                print('WARNING: data column name "%s" contains spaces. '
+                      'Will be renamed to "%s". '
+                      'Please use new name in template' % (
+                          column, new_name))
+            columns[i] = new_name
+    return columns
+
+
+def load_data(source, sheet_name=None, usecols=None, data_cache=True):
+    """Load a sheet of `source` (a `DataSource`) as pandas.DataFrame, with
+    empty lines dropped and spaces in the column names replaced by
+    underscores.
+
+    :param sheet_name: Sheet name to load, see `DataSource.get_sheet_name`.
+    :param usecols: None or function, the columns to load, see
+        `DataSource`. Whether a line is empty is decided by all columns,
+        so the rows are the same whichever columns are loaded.
+    :param data_cache: bool, string or `DataCache`;
+        If True (default), sheets of cacheable sources are cached in the
+        default `DataCache`, so they are only parsed again if the file
+        changed. Only the columns selected by `usecols` are parsed and
+        cached, unless the whole sheet is cached already. A string is
+        used as cache directory. Set to False to always read the source.
+
+    """
+    if data_cache is True:
+        data_cache = DataCache()
+    elif data_cache and not isinstance(data_cache, DataCache):
+        data_cache = DataCache(data_cache)
+    if not (data_cache and source.cacheable):
+        data = source.read_nonempty(sheet_name, usecols)
+        data.columns = _rename_columns(data.columns)
+        return data
+
+    columns = None
+    if usecols is not None:
+        columns = [c for c in source.read_columns(sheet_name) if usecols(c)]
+    data = data_cache.get(source, sheet_name, columns)
+    if data is None:
+        data = source.read_nonempty(sheet_name, usecols)
+        data.columns = _rename_columns(data.columns)
+        data_cache.put(source, sheet_name, data, columns)
+    return data
+
+
+class CachingURLFetcher(object):
+
+    def __init__(self, max_size=64 * 2**20, fetcher=None):
+        """Create a cache for the resources (stylesheets, images, fonts)
+        fetched by WeasyPrint, keeping them in memory, so repeated loads
+        of the same resource are served from there. Pass the result of
+        `get_url_fetcher` as `url_fetcher` to WeasyPrint.
+
+        Local files are keyed by their URL and modification time, so
+        changed files will be fetched again.
+
+        :param max_size: int;
+            Maximum total size in bytes of cached resources. If exceeded,
+            the least recently used resources will be dropped.
+        :param fetcher: None or URL fetcher;
+            URL fetcher to fetch resources that are not in the cache,
+            with the interface of the installed WeasyPrint version: a
+            `weasyprint.urls.URLFetcher` instance, or for older versions
+            a function like `weasyprint.default_url_fetcher`. If None
+            (default), WeasyPrint's default fetcher is used.
+
+        """
+        self.max_size = max_size
+        self.fetcher = fetcher
+        # cached resources and their sizes, by key (see `_get_key`):
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_url_fetcher(self):
+        """Return the URL fetcher to pass to WeasyPrint, using this cache.
+        """
+        import weasyprint
+        if not hasattr(weasyprint, 'default_url_fetcher'):
+            # newer versions take an instance of `weasyprint.urls.URLFetcher`:
+            return _get_url_fetcher_class()(self)
+        if self.fetcher is None:
+            self.fetcher = weasyprint.default_url_fetcher
+        return self
+
+    def __call__(self, url, *args, **kwargs):
+        # the URL fetcher interface of older WeasyPrint versions, which
+        # return a dict with the resource:
+        def fetch():
+            result = dict(self.fetcher(url, *args, **kwargs))
+            if 'file_obj' in result:
+                file_obj = result.pop('file_obj')
+                try:
+                    result['string'] = file_obj.read()
+                finally:
+                    file_obj.close()
+            return result, len(result.get('string') or b'')
+
+        return dict(self.get(url, fetch))
+
+    def get(self, url, fetch):
+        """Return the cached resource of `url`, or else the one returned by
+        `fetch`, a function returning a tuple (resource, size in bytes).
+        """
+        key = self._get_key(url)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        resource, size = fetch()
+
+        with self.lock:
+            if size <= self.max_size and key not in self.cache:
+                self.cache[key] = (resource, size)
+                self.size += size
+                while self.size > self.max_size:
+                    _, (_, dropped_size) = self.cache.popitem(last=False)
+                    self.size -= dropped_size
+        return resource
+
+    @staticmethod
+    def _get_key(url):
+        if url.startswith('file:'):
+            path = urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+            try:
+                return url, os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return url, None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_url_fetcher_class():
+    """Return a subclass of `weasyprint.urls.URLFetcher` fetching through a
+    `CachingURLFetcher`, for WeasyPrint versions with that interface.
+    """
+    from weasyprint.urls import URLFetcher, URLFetcherResponse
+
+    class CachedURLFetcher(URLFetcher):
+
+        def __init__(self, cache, **kwargs):
+            super().__init__(**kwargs)
+            self.cache = cache
+
+        def fetch(self, url, headers=None):
+            def fetch():
+                if self.cache.fetcher is None:
+                    response = super(CachedURLFetcher, self).fetch(
+                        url, headers)
+                else:
+                    response = self.cache.fetcher.fetch(url, headers)
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                return ((response.url, body, dict(response.headers.items()),
+                         response.status), len(body))
+
+            response_url, body, response_headers, status = self.cache.get(
+                url, fetch)
+            return URLFetcherResponse(
+                response_url, body, response_headers, status)
+
+    return CachedURLFetcher
+
+
+class RenderManifest(object):
+
+    def __init__(self, file_name, template_hash, save_every=100):
+        """Create a manifest of rendered files, used to skip rows whose
+        output is unchanged when rerunning a conversion.
+
+        For each output file, the hash of its inputs (template, assets
+        referenced by the template, and the values of the row) and the
+        hash of the output file itself are recorded. The manifest is
+        loaded from `file_name` if it exists.
+
+        :param file_name: string;
+            File name of the manifest (a JSON file).
+        :param template_hash: string;
+            hash of the template and its assets, see
+            `FormLetter.get_template_hash`.
+        :param save_every: int;
+            Save the manifest after this many added files, so not all
+            is lost if a run is interrupted.
+
+        """
+        self.file_name = file_name
+        self.directory = os.path.dirname(os.path.abspath(file_name))
+        self.template_hash = template_hash
+        self.save_every = save_every
+        self.entries = {}
+        if os.path.isfile(file_name):
+            with open(file_name, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('files', {})
+        # input hashes of files checked, but not yet added:
+        self._pending = {}
+        self._unsaved = 0
+        self.unchanged = 0
+
+    def _get_key(self, output_file):
+        return os.path.relpath(os.path.abspath(output_file), self.directory)
+
+    def get_input_hash(self, record, settings=None):
+        h = hashlib.sha256(self.template_hash.encode())
+        h.update(repr(list(record.items())).encode('utf-8'))
+        if settings:
+            h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def is_up_to_date(self, output_file, record, settings=None):
+        """Return True if `output_file` exists and was rendered from the
+        same template, row values and `settings` (a JSON serializable
+        dict of options of the run changing the output), and was not
+        changed since.
+        """
+        key = self._get_key(output_file)
+        input_hash = self.get_input_hash(record, settings)
+        entry = self.entries.get(key)
+        if (entry is not None and entry['input'] == input_hash
+                and os.path.isfile(output_file)
+                and _get_file_hash(output_file) == entry['output']):
+            self.unchanged += 1
+            return True
+        self._pending[key] = input_hash
+        return False
+
+    def add(self, output_file):
+        """Record that `output_file` was rendered successfully, after
+        it has been checked with `is_up_to_date`.
+        """
+        key = self._get_key(output_file)
+        self.entries[key] = {
+            'input': self._pending.pop(key),
+            'output': _get_file_hash(output_file)}
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'files': self.entries}, f, indent=1)
+        os.replace(tmp_name, self.file_name)
+        self._unsaved = 0
+
+
+class ArchiveWriter(object):
+
+    def __init__(self, file_name, compress=False):
+        """Create an output for `FormLetter` (see its `output`
+        parameter) which writes all PDF files into one single ZIP or tar
+        archive instead of the file system, avoiding the overhead of
+        creating many small files, e.g. on network shares.
+
+        The file names of the PDF files are used as names of the
+        archive members; use relative names.
+
+        :param file_name: string;
+            File name of the archive. The format is chosen by its
+            extension: '.zip', '.tar', '.tar.gz' or '.tgz', '.tar.bz2'
+            or '.tar.xz'.
+        :param compress: bool;
+            If True, compress the members of a ZIP archive. The default
+            is False, since the streams in PDF files are compressed
+            already.
+
+        """
+        self.file_name = file_name
+        name = file_name.lower()
+        if name.endswith('.zip'):
+            self.zip = zipfile.ZipFile(
+                file_name, 'w', zipfile.ZIP_DEFLATED if compress
+                                else zipfile.ZIP_STORED)
+            self.tar = None
+        else:
+            for extensions, mode in ((('.tar',), 'w'),
+                                     (('.tar.gz', '.tgz'), 'w:gz'),
+                                     (('.tar.bz2',), 'w:bz2'),
+                                     (('.tar.xz',), 'w:xz')):
+                if name.endswith(extensions):
+                    break
+            else:
+                raise ValueError(
+                    "unknown archive format: %s" % file_name)
+            self.zip = None
+            self.tar = tarfile.open(file_name, mode)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    @staticmethod
+    def _get_member_name(file_name):
+        return os.path.normpath(file_name).replace(os.sep, '/').lstrip('/')
+
+    def write(self, file_name, data):
+        """Add a file with the content `data` (bytes) to the archive."""
+        name = self._get_member_name(file_name)
+        with self.lock:
+            if self.zip is not None:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = self.zip.compression
+                info.external_attr = 0o644 << 16
+                self.zip.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                info.mode = 0o644
+                self.tar.addfile(info, io.BytesIO(data))
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            (self.zip or self.tar).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BackgroundWriter(object):
+
+    def __init__(self, output=None, threads=1, queue_size=16, fsync=False,
+                 atomic=True, observers=None):
+        """Create an output for `FormLetter` (see its `output`
+        parameter) which writes the PDF files in background threads, so
+        rendering does not wait for the storage.
+
+        The files are put into a bounded queue, so rendering only waits
+        if the writers fall behind by `queue_size` files. Errors while
+        writing are collected in `errors` and returned by `wait_for`.
+
+        :param output: None or object with a method `write(file_name,
+            data)`, e.g. an `ArchiveWriter`;
+            If None (default), the files are written to the file system.
+            Else, `output.write` is called in the background threads,
+            and `output` is closed with this writer.
+        :param threads: int;
+            Number of writer threads. If 0, the files are written
+            immediately by `write`.
+        :param queue_size: int;
+            Maximum number of files waiting to be written.
+        :param fsync: bool;
+            If True, flush each file to the disk before it is considered
+            written. Slower, but the files survive a system crash.
+        :param atomic: bool;
+            If True (default), each file is written under a temporary
+            name and renamed when complete, so no partially written
+            files appear, e.g. if the process is killed.
+        :param observers: None or list of functions;
+            Each is called with the arguments `('write_file', None,
+            seconds)` after a file is written by a writer thread, like
+            the observers of `FormLetter`, e.g. with its list
+            `observers`. (The row is not known to the writer.)
+
+        """
+        self.output = output
+        self.observers = observers if observers is not None else []
+        self.fsync = fsync
+        self.atomic = atomic
+        self.queue = queue.Queue(queue_size)
+        self.condition = threading.Condition()
+        # numbers of queued, but not yet written files, by file name:
+        self.pending = collections.Counter()
+        # exceptions raised while writing, by file name:
+        self.errors = {}
+        self.threads = [threading.Thread(target=self._run, daemon=True)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def writes_files(self):
+        return self.output is None
+
+    def write(self, file_name, data):
+        """Queue a file with the content `data` (bytes) for writing.
+        Blocks while the queue is full.
+        """
+        if not self.threads:
+            self._write(file_name, data)
+            return
+        with self.condition:
+            self.pending[file_name] += 1
+            self.errors.pop(file_name, None)
+        self.queue.put((file_name, data))
+
+    def wait_for(self, file_name):
+        """Wait until `file_name` is written and return the exception
+        raised while writing it, or None.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: file_name not in self.pending)
+            return self.errors.get(file_name)
+
+    def flush(self):
+        """Wait until all queued files are written."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+
+    def close(self):
+        """Write all queued files, stop the threads and close the
+        wrapped output.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.output is not None:
+            self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            file_name, data = item
+            start = time.perf_counter()
+            try:
+                self._write(file_name, data)
+                error = None
+            except Exception as e:
+                error = e
+            seconds = time.perf_counter() - start
+            for observer in self.observers:
+                observer('write_file', None, seconds)
+            with self.condition:
+                if error is not None:
+                    self.errors[file_name] = error
+                self.pending[file_name] -= 1
+                if not self.pending[file_name]:
+                    del self.pending[file_name]
+                self.condition.notify_all()
+
+    def _write(self, file_name, data):
+        if self.output is not None:
+            self.output.write(file_name, data)
+            return
+        if not self.atomic:
+            self._write_data(file_name, data)
+            return
+        directory, name = os.path.split(file_name)
+        tmp_name = os.path.join(
+            directory, '.%s.%x.tmp' % (name, threading.get_ident()))
+        try:
+            self._write_data(tmp_name, data)
+            os.replace(tmp_name, file_name)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            # make the rename itself durable:
+            fd = os.open(directory or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write_data(self, file_name, data):
+        with open(file_name, 'wb') as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class _CollectingOutput(object):
+    """Output keeping the written files in memory, so they can be
+    written by another process. Used by worker processes, see
+    `_render_worker`.
+    """
+
+    def __init__(self, writes_files=False):
+        # whether the files end up in the file system, see
+        # `FormLetter._writes_files`:
+        self.writes_files = writes_files
+        # tuples (file_name, data):
+        self.files = []
+        # tuples (source, file_name) of duplicates to be copied, see
+        # `FormLetter._reuse_duplicate`:
+        self.copies = []
+
+    def write(self, file_name, data):
+        self.files.append((file_name, data))
+
+    def copy(self, source, file_name):
+        self.copies.append((source, file_name))
+
+
+class StageProfiler(object):
+    """Observer for `FormLetter` (see its `observers` parameter)
+    collecting the time spent in each stage of the processing.
+    """
+
+    stages = ('load', 'html', 'layout', 'write_pdf', 'write_wait',
+              'write_file')
+
+    def __init__(self, max_samples=None):
+        """Create a profiler.
+
+        :param max_samples: None or int;
+            If given, the percentiles are computed from only this many
+            most recent durations of each stage, so the memory use of
+            long-running processes is bounded. Counts and totals are
+            kept for all durations.
+
+        """
+        # (most recent) durations in seconds, by stage:
+        self.durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=max_samples))
+        self.counts = collections.Counter()
+        self.totals = collections.defaultdict(float)
+        # total duration of all stages, by row:
+        self.row_durations = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, row, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            if row is not None:
+                self.row_durations[row] += seconds
+
+    @staticmethod
+    def _percentile(values, percent):
+        # nearest-rank percentile of sorted `values`:
+        index = max(0, -(-len(values) * percent // 100) - 1)
+        return values[int(index)]
+
+    def get_summary(self):
+        """Return a dictionary with count, total, mean, p50, p90, p99
+        and max of the durations of each stage, in seconds.
+        """
+        summary = {}
+        with self.lock:
+            durations = {stage: sorted(values)
+                         for stage, values in self.durations.items()}
+        known = [stage for stage in self.stages if stage in durations]
+        other = sorted(set(durations) - set(self.stages))
+        for stage in known + other:
+            values = durations[stage]
+            summary[stage] = dict(
+                count=self.counts[stage],
+                total=self.totals[stage],
+                mean=self.totals[stage] / self.counts[stage],
+                p50=self._percentile(values, 50),
+                p90=self._percentile(values, 90),
+                p99=self._percentile(values, 99),
+                max=values[-1])
+        return summary
+
+    def get_slowest_rows(self, count=10):
+        """Return a list of tuples (row, seconds) of the `count` rows
+        which took longest over all stages, slowest first.
+        """
+        return sorted(self.row_durations.items(),
+                      key=lambda item: item[1], reverse=True)[:count]
+
+    def to_dict(self, count=10):
+        return dict(
+            stages=self.get_summary(),
+            slowest_rows=[dict(row=row, seconds=seconds)
+                          for row, seconds in self.get_slowest_rows(count)])
+
+    def save(self, file_name, count=10):
+        """Write the report as JSON file."""
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(count), f, indent=2)
+
+    def report(self, count=10):
+        """Return the report as human-readable text."""
+        lines = ["%-10s %7s %9s %9s %9s %9s %9s %9s" % (
+            "stage", "count", "total/s", "mean/ms", "p50/ms", "p90/ms",
+            "p99/ms", "max/ms")]
+        for stage, s in self.get_summary().items():
+            lines.append(
+                "%-10s %7i %9.3f %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+                    stage, s['count'], s['total'], s['mean'] * 1e3,
+                    s['p50'] * 1e3, s['p90'] * 1e3, s['p99'] * 1e3,
+                    s['max'] * 1e3))
+        slowest = self.get_slowest_rows(count)
+        if slowest:
+            lines.append("slowest rows (data row: ms):")
+            lines.extend("  %i: %.2f" % (row + 1, seconds * 1e3)
+                         for row, seconds in slowest)
+        return "\n".join(lines)
+
 
 class FormLetter(object):
 
-    def __init__(self, template, datafile, sheet_name=None):
+    def __init__(self, template, datafile, sheet_name=None,
+                 precompile_css=True, url_cache_size=64 * 2**20,
+                 chunksize=None, dedup=False, bytecode_cache=True,
+                 locale=None, custom_formatters=None, observers=None,
+                 output=None, usecols=None, data_cache=True,
+                 verbose=True):
         """Create a FormLetter object.
 
         :param template: filename of template file (.html file) which will
             be filled by the datafile table entries.
 
-        :param datafile: filename of table file (e.g. .csv or .xlsx) which
-            will be used to fill template.
+        :param datafile: filename or URI of table data which will be used
+            to fill template, e.g. a .csv, .xlsx, .parquet or .feather
+            file, an SQLite database or 'sqlite:///data.db?table=x' (see
+            `get_data_source`), or a pandas.DataFrame which is already
+            loaded (it is not modified). If None, no data is
+            loaded and only `fill_template` and `write_record_to_pdf`
+            can be used.
+
+        :param sheet_name: Sheet name of datafile to be used, if excel file,
+            or table name, if SQLite database. If None (default), the
+            first sheet will be used.
+
+        :param precompile_css: bool;
+            If True (default), the static stylesheets of the template
+            (`<style>` elements and `<link rel="stylesheet">` tags without
+            template syntax in them) will be parsed only once and reused
+            for every row, together with a shared font configuration,
+            as long as this gives the same cascade, see `render_html`.
+            Set to False to let WeasyPrint parse them anew for every row.
+
+        :param url_cache_size: int;
+            Maximum size in bytes of the in-memory cache for resources
+            referenced by the template (images, fonts, stylesheets), see
+            `CachingURLFetcher`. Use 0 to disable the cache.
+
+        :param chunksize: None or int;
+            If None (default), the whole datafile is loaded into memory.
+            Otherwise, the data is streamed: it is read in chunks of this
+            many rows whenever it is iterated over (see `iter_records`),
+            so memory use is bounded by the chunk size instead of the
+            file size. Only the methods taking a list of rows can be used
+            then, and `get_number_of_rows` returns None.
+
+        :param dedup: False, 'copy' or 'link';
+            If not False, rows whose filled template is identical to one
+            already rendered by this instance are not rendered again, but
+            the PDF file produced before is copied, or hard linked if
+            'link'. True is the same as 'copy'. Worker processes each
+            keep their own record of rendered files.
 
-        :param sheet_name: Sheet name of datafile to be used, if .xlsx file.
-            If None (default), the first sheet will be used.
+        :param bytecode_cache: bool or string;
+            If True (default), the compiled template is cached on disk in
+            jinja2's default cache directory, so further instances (e.g.
+            in worker processes or later runs) need not compile it again.
+            The cache is keyed by the template's file name and checked
+            against its source. A string is used as cache directory.
+            Set to False to disable the cache.
+
+        :param locale: None or locale identifier, e.g. 'de_DE' or 'en_US';
+            The default locale used by the formatters in the template,
+            see `Formatters`. Can be overridden in `get_filled_html`.
+
+        :param custom_formatters: None or dict;
+            Formatters for individual columns, with the column names as
+            keys. Each value is a one-parameter function returning a
+            unicode string, or the name of one of the formatters in the
+            template, e.g. 'format_amount' or 'format_date'. The columns
+            are formatted once, right after loading (or for each chunk,
+            in streaming mode), and the formatted strings replace the
+            values; empty cells become empty strings. Each distinct value
+            is only formatted once.
+
+        :param observers: None or list of functions;
+            Each is called after every stage of the processing with the
+            arguments `(stage, row, seconds)`, where `stage` is one of
+            'load' (reading the datafile, or a chunk of it in streaming
+            mode), 'html' (filling the template), 'layout' (WeasyPrint
+            layout), 'write_pdf' (serializing the PDF) and 'write_file'
+            (writing it to disk; with a `BackgroundWriter` with threads
+            as `output`, this is 'write_wait', waiting for a free place
+            in its queue, and the writer reports 'write_file' if it has
+            observers), `row` is the row number being
+            processed (the first one of a layout batch, None if not
+            known) and `seconds` the wall-clock time the stage took.
+            Stages run in worker processes are reported when their
+            results arrive. See `add_observer` and `StageProfiler`.
+
+        :param output: None or object with a method `write(file_name,
+            data)`;
+            Where the PDF files are written to. If None (default), they
+            are written to the file system. Else, their content is
+            passed to `output.write`, e.g. of a `BackgroundWriter` or
+            an `ArchiveWriter`; with worker processes, the content is
+            sent back to this process to be written there. Can also be
+            set later as attribute `output`. Deduplication (see `dedup`)
+            and manifests (see `open_manifest`) need files in the file
+            system, so they only work with outputs writing them there,
+            i.e. with a `writes_files` attribute which is True.
+
+        :param usecols: None or list of column names;
+            If None (default), all columns of the data are loaded.
+            Else, only the columns referenced by the template (and the
+            templates it includes, see `get_template_variables`), the
+            ones with a custom formatter and the ones in `usecols` (e.g.
+            the fields of a file name pattern, see `get_pattern_fields`,
+            or columns used to skip rows) are loaded, which saves time
+            and memory for wide tables. Column names may be given with
+            spaces or underscores. Empty lines are still recognized by
+            all columns, so the row numbers don't depend on `usecols`;
+            for sources which cannot tell that cheaply (e.g. CSV and
+            Excel files), all columns are read.
+
+        :param data_cache: bool or string;
+            If True (default), the parsed data of Excel and CSV files is
+            cached on disk (see `DataCache`), so further runs on the same,
+            unchanged file need not parse it again. A string is used as
+            cache directory. Set to False to disable the cache. Not used
+            in streaming mode.
+
+        :param verbose: bool;
+            If True (default), print some information about the loaded
+            data. Set to False e.g. in worker processes.
 
         """
-        self.template_file = template
+        # remember the arguments, so worker processes (see
+        # `iter_render_batch`) can create their own instance; they get
+        # the data with each task, so they do not load the datafile:
+        self._init_args = (template, None)
+        self._init_kwargs = dict(
+            precompile_css=precompile_css, url_cache_size=url_cache_size,
+            dedup=dedup, bytecode_cache=bytecode_cache, locale=locale,
+            verbose=False)
+        # latest statistics of each worker process, by process id:
+        self._worker_stats = {}
 
-        self.datafile = datafile
-        self.data_ext = os.path.splitext(datafile)[-1]
-        if self.data_ext == '.xlsx':
-            # open excel file
-            xl = pd.ExcelFile(datafile)
-            if sheet_name is None:
-                self.sheet_name = xl.sheet_names[0]
-            elif sheet_name in xl.sheet_names:
-                self.sheet_name = sheet_name
-            else:
-                raise ValueError("sheet name '%s' not in file" % sheet_name)
-            self.data = xl.parse(self.sheet_name)
-        else:
-            try:
-                self.data = pd.read_csv(datafile)
-            except pd.errors.ParserError as pe:
-                print("unknown data file format")
-                raise pe
+        self.observers = list(observers or [])
+        # row number reported to the observers, see `_stage`:
+        self.current_row = None
 
-        # drop emtpy lines (where all values are nan):
-        self.data = self.data.dropna(axis=0, how='all')
+        self.template_file = template
 
-        # find column names with spaces:
-        columns = list(self.data.columns)
-        for i, column in enumerate(columns):
-            if " " in column:
-                new_name = column.replace(" ", "_")
-                print('WARNING: data column name "%s" contains spaces. '
-                      'Will be renamed to "%s". '
-                      'Please use new name in template' % (column, new_name))
-                columns[i] = new_name
-        self.data.columns = columns
+        self.output = output
 
-        # prepare substitution dictionary, will be used for every row:
-        self.subdict = {key: "" for key in self.data.columns}
+        self.dedup = 'copy' if dedup is True else dedup
+        # file names of rendered PDF files, by hash of their html:
+        self._dedup_files = {}
+        self.dedup_saved = 0
 
+        import jinja2
+        if bytecode_cache is True:
+            bytecode_cache = jinja2.FileSystemBytecodeCache()
+        elif bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache)
+        else:
+            bytecode_cache = None
         self.env = jinja2.Environment(
                 loader=jinja2.FileSystemLoader(
-                        os.path.split(self.template_file)[0]))
+                        os.path.split(self.template_file)[0]),
+                bytecode_cache=bytecode_cache)
 
         # Add some formatters to Jinja environment, so they can be
         # used in the template:
-        self.env.filters['format_currency'] = babel.numbers.format_currency
-        self.env.filters['format_percent'] = babel.numbers.format_percent
-        self.env.filters['format_decimal'] = babel.numbers.format_decimal
-        self.env.filters['format_amount'] = lambda x: babel.numbers.format_decimal(
-            x, format=u'#,##0.00')
-        self.env.filters['format_date'] = babel.dates.format_date
-        self.env.filters['format_datetime'] = babel.dates.format_datetime
+        self.locale = locale
+        self.env.filters.update(Formatters(locale).get_filters())
         # TODO self.env.filters['format_adapted_date'] = date_formatter
 
         self.template = self.env.get_template(
                 os.path.split(self.template_file)[1])
+        # templates using the formatters of other locales, by locale:
+        self._templates = {locale: self.template}
+
+        self.sheet_name = None
+        self.chunksize = chunksize
+        self.data = None
+        # function telling whether to load a column, or None for all:
+        self._usecols = None
+        if datafile is not None:
+            template_variables = self.get_template_variables()
+            self._usecols = self._get_usecols(
+                usecols, custom_formatters, template_variables)
+        if datafile is None:
+            self.datafile = None
+            self.source = None
+            columns = []
+        elif not isinstance(datafile, (str, os.PathLike)):
+            # an in-memory DataFrame:
+            self.datafile = None
+            self.source = None
+            self.chunksize = None
+            with self._stage('load'):
+                # drop emtpy lines (returns a copy, so the caller's
+                # DataFrame is not changed):
+                self.data = datafile.dropna(axis=0, how='all')
+                if self._usecols is not None:
+                    self.data = self.data[
+                        [c for c in self.data.columns if self._usecols(c)]]
+            columns = self.data.columns
+        elif chunksize:
+            self.datafile = datafile
+            self.source = get_data_source(datafile)
+            self.sheet_name = self.source.get_sheet_name(sheet_name)
+            columns = self.source.read_columns(self.sheet_name)
+            if self._usecols is not None:
+                columns = [c for c in columns if self._usecols(c)]
+        else:
+            self.datafile = datafile
+            self.source = get_data_source(datafile)
+            with self._stage('load'):
+                self.sheet_name = self.source.get_sheet_name(sheet_name)
+                self.data = load_data(
+                    self.source, self.sheet_name, self._usecols, data_cache)
+            columns = self.data.columns
+
+        # find column names with spaces:
+        columns = _rename_columns(columns)
+        self.columns = columns
+        if self.data is not None:
+            self.data.columns = columns
+
+        # prepare substitution dictionary, will be used for every row:
+        self.subdict = {key: "" for key in self.columns}
+
+        if datafile is not None:
+            self._check_template_variables(template_variables)
+
+        self.custom_formatters = self._get_custom_formatters(
+            custom_formatters)
+        if self.data is not None:
+            self.data = self.format_columns(self.data)
+        self._build_row_store()
+
+        # Relative URLs in the template (stylesheets, images, fonts) are
+        # relative to the template file:
+        self.base_url = pathlib.Path(
+            os.path.abspath(self.template_file)).parent.as_uri() + '/'
+        # WeasyPrint state shared by all rows, created on first use,
+        # see `_init_weasyprint`:
+        self.precompile_css = precompile_css
+        self.url_cache_size = url_cache_size
+        self.font_config = None
+        # CachingURLFetcher, or None if disabled:
+        self.url_cache = None
+        # URL fetcher passed to WeasyPrint, None for its default:
+        self.url_fetcher = None
+        # list of tuples (tag in html, weasyprint.CSS, bool), see
+        # `_compile_stylesheets`:
+        self.stylesheets = None
+
+        if verbose and self.data is not None:
+            print(self.data.columns) # TODO debugging only
+            print(self.data.head())
+            #print(self.data.dtypes)
+            print()
+            print()
+
+    @staticmethod
+    def _get_usecols(usecols, custom_formatters, template_variables):
+        """Return a function telling whether a data column is to be
+        loaded, or None if all are, see `usecols` parameter of the
+        constructor.
+        """
+        if usecols is None:
+            return None
+        if template_variables is None:
+            print('WARNING: the template includes templates by variable '
+                  'names. All data columns will be loaded.')
+            return None
+        wanted = set(template_variables)
+        wanted.update(str(column).replace(" ", "_")
+                      for column in itertools.chain(
+                          usecols, custom_formatters or ()))
+        return lambda column: str(column).replace(" ", "_") in wanted
+
+    def _check_template_variables(self, variables):
+        """Warn about variables in the template which are no data
+        columns.
+        """
+        for name in sorted((variables or set()) - set(self.columns)
+                           - set(self.env.globals)):
+            print('WARNING: the template uses "%s", which is not a '
+                  'data column' % name)
+
+    def get_template_variables(self):
+        """Return the set of variables used, but not defined, by the
+        template and the templates it includes or extends, i.e. the data
+        columns it needs. Returns None if it includes templates by
+        variable names, which can not be analyzed.
+        """
+        import jinja2.meta
+        variables = set()
+        for _, ast in self._iter_template_sources():
+            if None in jinja2.meta.find_referenced_templates(ast):
+                return None
+            variables |= jinja2.meta.find_undeclared_variables(ast)
+        return variables
+
+    def _iter_template_sources(self):
+        """Yield tuples (source, parsed template) of the template and
+        all templates it includes or extends.
+        """
+        import jinja2.meta
+        names = [os.path.split(self.template_file)[1]]
+        seen = set(names)
+        while names:
+            source = self.env.loader.get_source(self.env, names.pop())[0]
+            ast = self.env.parse(source)
+            yield source, ast
+            for name in jinja2.meta.find_referenced_templates(ast):
+                if name is not None and name not in seen:
+                    seen.add(name)
+                    names.append(name)
+
+    @staticmethod
+    def get_pattern_fields(filename_pattern):
+        """Return the list of column names used in a file name pattern
+        (see `get_file_name`), e.g. for the `usecols` parameter of the
+        constructor.
+        """
+        import string
+        fields = []
+        for _, field, _, _ in string.Formatter().parse(filename_pattern):
+            if field:
+                # e.g. 'Person' of '{Person.upper}' or '{Person[0]}':
+                field = re.split(r'[.\[]', field, 1)[0]
+                if field != 'row' and field not in fields:
+                    fields.append(field)
+        return fields
+
+    def _get_custom_formatters(self, custom_formatters):
+        """Return a dict of the formatting functions by (renamed) column
+        name, see parameter `custom_formatters` of the constructor.
+        """
+        formatters = {}
+        for column, formatter in (custom_formatters or {}).items():
+            column = column.replace(" ", "_")
+            if self.columns and column not in self.columns:
+                raise KeyError(
+                    "custom formatter for unknown column '%s'" % column)
+            if isinstance(formatter, str):
+                formatter = self.env.filters[formatter]
+            formatters[column] = formatter
+        return formatters
+
+    def format_columns(self, data, custom_formatters=None):
+        """Return `data` with the columns having a custom formatter
+        replaced by their formatted values.
+
+        Each distinct value of a column is formatted only once.
+
+        :param data: pandas.DataFrame
+        :param custom_formatters: None or dict;
+            If None (default), the custom formatters given to the
+            constructor are used.
+        :returns:
+            pandas.DataFrame
+
+        """
+        import pandas as pd
+        import numpy as np
+        if custom_formatters is None:
+            custom_formatters = self.custom_formatters
+        if not custom_formatters:
+            return data
+        data = data.copy()
+        for column, formatter in custom_formatters.items():
+            if column not in data.columns:
+                continue
+            codes, uniques = pd.factorize(data[column])
+            # the extra last entry is used for empty cells (code -1):
+            formatted = np.array(
+                [formatter(value) for value in uniques] + [""], dtype=object)
+            data[column] = formatted[codes]
+        return data
 
-        print(self.data.columns) # TODO debugging only
-        print(self.data.head())
-        #print(self.data.dtypes)
-        print()
-        print()
+    def _build_row_store(self):
+        """Prepare `self.rows`, a list with a tuple of values for each row
+        of the loaded data, in the order of `self.columns`, for cheap
+        row access without creating a pandas Series per row. Must be
+        called again whenever `self.data` is changed.
+        """
+        if self.data is None:
+            self.rows = None
+        else:
+            self.rows = list(self.data.itertuples(index=False, name=None))
+
+    def iter_data_chunks(self):
+        """Yield the data as DataFrames with the row numbers as index.
+
+        If the data is loaded into memory, it is yielded at once, else
+        (in streaming mode, see `chunksize` parameter of the constructor)
+        it is read from the datafile in chunks of `chunksize` rows.
+        """
+        import pandas as pd
+        if self.data is not None:
+            yield self.data.set_axis(
+                pd.RangeIndex(self.data.shape[0]), axis=0)
+            return
+        if self.datafile is None:
+            return
+        # (without the empty lines, where all values are nan)
+        chunks = iter(self.source.iter_nonempty_chunks(
+            self.chunksize, self.sheet_name, self._usecols))
+        start = 0
+        while True:
+            with self._stage('load'):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                chunk.columns = self.columns
+                chunk.index = pd.RangeIndex(start, start + chunk.shape[0])
+                start += chunk.shape[0]
+                chunk = self.format_columns(chunk)
+            yield chunk
+
+    def iter_records(self, indexes=None, skip=None):
+        """Yield the data of the specified rows.
+
+        :param indexes:
+            iterable of row numbers. start counting at 0. If None
+            (default), all rows are used. In streaming mode, the rows
+            are always yielded in the order of the datafile.
+        :param skip: None, function, string or boolean array;
+            Rows to leave out. A function is called with the data of
+            each row, and rows for which it returns True are left out.
+            An expression or a mask (see `select_rows`) is evaluated for
+            all rows at once (for each chunk, in streaming mode), so the
+            skipped rows are never visited, which is much faster.
+        :yields:
+            tuples (row, record), where record maps the column names
+            to the values of the row.
+        """
+        if skip is not None and not callable(skip):
+            if self.data is not None:
+                indexes = self.select_rows(indexes, skip)
+                skip = None
+            elif not isinstance(skip, str):
+                raise ValueError(
+                    "only expressions can be used to skip rows in "
+                    "streaming mode")
+        if self.data is not None:
+            if indexes is None:
+                indexes = range(self.get_number_of_rows())
+            for row in indexes:
+                record = self.get_data_row(row)
+                if skip is None or not skip(record):
+                    yield row, record
+            return
+        wanted = None if indexes is None else set(indexes)
+        for chunk in self.iter_data_chunks():
+            if wanted is not None:
+                chunk = chunk[chunk.index.isin(wanted)]
+            if isinstance(skip, str):
+                chunk = chunk[~self._get_skip_mask(chunk, skip)]
+            for row, values in zip(
+                    chunk.index, chunk.itertuples(index=False, name=None)):
+                record = dict(zip(self.columns, values))
+                if not callable(skip) or not skip(record):
+                    yield row, record
 
+    def select_rows(self, indexes=None, skip=None):
+        """Return the numbers of the rows to convert, without visiting
+        the rows one by one. Not available in streaming mode.
+
+        :param indexes:
+            iterable of row numbers. start counting at 0. If None
+            (default), all rows are used.
+        :param skip: None, string or boolean array;
+            Rows to leave out: an expression over the columns, evaluated
+            for all rows at once with `pandas.DataFrame.eval`, which is
+            true for the rows to skip, e.g.
+            'Status == "sent" or Amount <= 0'; column names which are
+            no Python identifiers must be quoted with backticks. Or an
+            array with True for each row to skip, e.g. from
+            `get_column_mask`. Note that columns with a custom formatter
+            contain the formatted strings.
+        :returns:
+            list of row numbers, in the order of `indexes`.
+
+        """
+        import numpy as np
+        if self.data is None:
+            raise ValueError("rows can not be selected in streaming mode")
+        if indexes is None:
+            indexes = np.arange(self.get_number_of_rows())
+        else:
+            indexes = np.fromiter(indexes, dtype=np.intp)
+        if skip is not None:
+            indexes = indexes[~self._get_skip_mask(self.data, skip)[indexes]]
+        return indexes.tolist()
+
+    @staticmethod
+    def _get_skip_mask(data, skip):
+        import numpy as np
+        if isinstance(skip, str):
+            skip = data.eval(skip)
+        mask = np.asarray(skip)
+        if mask.ndim == 0:
+            # e.g. an expression not depending on the columns:
+            mask = np.full(data.shape[0], mask)
+        # (empty cells are true, like in Python)
+        return mask.astype(bool)
+
+    def get_column_mask(self, column, value):
+        """Return a boolean array which is True for each row having
+        `value` in `column`, e.g. to skip these rows (see
+        `select_rows`). A string `value`, e.g. an input of the user,
+        is converted to the type of the column first.
+        """
+        import pandas as pd
+        series = self.data[column.replace(" ", "_")]
+        if isinstance(value, str):
+            value = pd.Series([value]).astype(series.dtype)[0]
+        return (series == value).to_numpy(dtype=bool, na_value=False)
 
-    def get_filled_html(self, row,
-            #TODO custom_formatters=None,
-            #TODO locale=None
-            ):
+    @staticmethod
+    def get_expression_fields(expression):
+        """Return the list of names which may be column names in an
+        expression (see `select_rows`), e.g. for the `usecols` parameter
+        of the constructor.
+        """
+        # leave out string literals:
+        expression = re.sub(r'"[^"]*"|\'[^\']*\'', '', expression)
+        return [quoted or name for quoted, name in re.findall(
+            r'`([^`]*)`|([^\W\d]\w*)', expression)]
+
+
+    def get_filled_html(self, row, custom_formatters=None, locale=None):
         """Return the template, filled with the data of the specified row,
         as HTML-formatted string.
 
@@ -128,26 +2120,61 @@ class FormLetter(object):
             the row number of data which will be used to fill the template.
             start counting at 0.
         :param custom_formatters: None or dict of one-parameter functions;
-            If None (default), a set of default formatters for each
-            column will be used, using babel.numbers and babel.dates.
+            If None (default), the values are used as they are (or as
+            formatted by the `custom_formatters` given to the
+            constructor, which is much faster for many rows).
             Individual formatting functions can be supplied with the
             column names as keys. The result of each function
             must be a unicode string.
         :param locale: None or locale identifier, e.g. 'de_DE' or 'en_US';
             The locale used for formatting numeric and date values with
-            babel. If None (default), the locale will be taken from the
-            `LC_NUMERIC` or `LC_TIME` environment variables on your
+            babel. If None (default), the locale given to the constructor
+            is used; if that is None too, the locale will be taken from
+            the `LC_NUMERIC` or `LC_TIME` environment variables on your
             system, for numeric or date values, respectively.
         :returns:
             HTML-formatted string
 
         """
-        # prepare substitution dictionary for current row:
-        self.subdict.update(self.data.iloc[row].items())
-        html = self.template.render(self.subdict)
+        self.current_row = row
+        record = self.get_data_row(row)
+        for column, formatter in (custom_formatters or {}).items():
+            record[column] = formatter(record[column])
+        return self.fill_template(record, locale)
+
+    def fill_template(self, record, locale=None):
+        """Return the template, filled with the data of `record`, as
+        HTML-formatted string.
+
+        :param record:
+            mapping of column names to values, e.g. from `iter_records`.
+        :param locale: None or locale identifier, see `get_filled_html`.
+        :returns:
+            HTML-formatted string
+
+        """
+        with self._stage('html'):
+            # prepare substitution dictionary for current row:
+            self.subdict.update(record)
+            html = self._get_template(locale).render(self.subdict)
 
         return html
 
+    def _get_template(self, locale):
+        if locale is None:
+            return self.template
+        template = self._templates.get(locale)
+        if template is None:
+            # The filters are looked up in the environment of a template,
+            # so it needs its own environment (and must not be shared via
+            # the template cache):
+            env = self.env.overlay(cache_size=0)
+            env.filters = dict(self.env.filters)
+            env.filters.update(Formatters(locale).get_filters())
+            template = env.get_template(os.path.split(self.template_file)[1])
+            self._templates[locale] = template
+        return template
+
 
     def write_to_pdf(self, row, file_name):
         """Save the template, filled with the data of the specified row,
@@ -160,9 +2187,425 @@ class FormLetter(object):
             Destination file name.
 
         """
-        html = self.get_filled_html(row)
-        doc = weasyprint.HTML(string=html)
-        doc.write_pdf(file_name)
+        self.current_row = row
+        self.write_record_to_pdf(self.get_data_row(row), file_name)
+
+    def write_record_to_pdf(self, record, file_name):
+        """Save the template, filled with the data of `record`, as PDF
+        file
+
+        :param record:
+            mapping of column names to values, e.g. from `iter_records`.
+        :param file_name: string;
+            Destination file name.
+
+        """
+        html = self.fill_template(record)
+        key = self._get_dedup_key(html)
+        if self._reuse_duplicate(key, file_name):
+            return
+        self._save_pdf(self.render_html(html), file_name)
+        self._remember_output(key, file_name)
+
+    def get_pdf(self, row, locale=None):
+        """Return the template, filled with the data of the specified row,
+        as PDF file content.
+
+        :param row:
+            the row number of data which will be used to fill the template.
+            start counting at 0.
+        :param locale: None or locale identifier, see `get_filled_html`.
+        :returns:
+            bytes
+
+        """
+        self.current_row = row
+        return self.get_record_pdf(self.get_data_row(row), locale)
+
+    def get_record_pdf(self, record, locale=None):
+        """Return the template, filled with the data of `record`, as PDF
+        file content.
+
+        :param record:
+            mapping of column names to values, e.g. from `iter_records`.
+        :param locale: None or locale identifier, see `get_filled_html`.
+        :returns:
+            bytes
+
+        """
+        doc = self.render_html(self.fill_template(record, locale))
+        with self._stage('write_pdf'):
+            return doc.write_pdf()
+
+    def _save_pdf(self, doc, file_name):
+        """Serialize the laid out `doc` and write it to `file_name`."""
+        with self._stage('write_pdf'):
+            data = doc.write_pdf()
+        self._write_file(file_name, data)
+
+    def _write_file(self, file_name, data):
+        # writer threads report the actual writing themselves:
+        stage = ('write_wait' if isinstance(self.output, BackgroundWriter)
+                 and self.output.threads else 'write_file')
+        with self._stage(stage):
+            if self.output is None:
+                with open(file_name, 'wb') as f:
+                    f.write(data)
+            else:
+                self.output.write(file_name, data)
+
+    def _writes_files(self):
+        return (self.output is None
+                or getattr(self.output, 'writes_files', False))
+
+    def wait_for_file(self, file_name):
+        """Wait until `file_name` is written by the output (see
+        `BackgroundWriter`), and return the exception raised while
+        writing it, or None.
+        """
+        wait_for = getattr(self.output, 'wait_for', None)
+        return None if wait_for is None else wait_for(file_name)
+
+    def _get_dedup_key(self, html):
+        if not self.dedup or not self._writes_files():
+            return None
+        return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+    def _remember_output(self, key, file_name):
+        if key is not None:
+            self._dedup_files[key] = file_name
+
+    def _reuse_duplicate(self, key, file_name):
+        """If a PDF file with the html hash `key` was rendered before,
+        copy or link it to `file_name` and return True.
+        """
+        source = self._dedup_files.get(key)
+        if source is None:
+            return False
+        copy = getattr(self.output, 'copy', None)
+        if copy is not None:
+            # the output copies it when the source is written:
+            copy(source, file_name)
+        elif not self._copy_file(source, file_name):
+            return False
+        self.dedup_saved += 1
+        return True
+
+    def _copy_file(self, source, file_name):
+        if (self.wait_for_file(source) is not None
+                or not os.path.isfile(source)):
+            return False
+        if os.path.abspath(source) != os.path.abspath(file_name):
+            if self.dedup == 'link':
+                if os.path.lexists(file_name):
+                    os.remove(file_name)
+                os.link(source, file_name)
+            else:
+                shutil.copyfile(source, file_name)
+        return True
+
+    def write_all_to_pdf(self, indexes, file_name, callback=None, skip=None,
+                         chunk_size=100):
+        """Save the template, filled with the data of each of the
+        specified rows, as one single PDF file, e.g. for printing.
+
+        Every row is rendered separately. To bound the memory use, the
+        laid out pages of every `chunk_size` rows are written to a
+        temporary PDF file, and these are joined at the end with pypdf,
+        which is required for this, straight into `file_name` (if the
+        output writes files, see `output`). pypdf keeps the serialized
+        pages in memory while joining, which are much smaller than the
+        laid out ones. If `chunk_size` is None, the laid out pages of
+        all rows are kept until the file is written.
+
+        :param indexes:
+            iterable of row numbers to convert. start counting at 0.
+            If None, all rows are converted.
+        :param file_name: string;
+            Destination file name.
+        :param callback: None or function;
+            If given, it will be called with the number of rows rendered
+            so far after each row.
+        :param skip: None or function;
+            Rows to leave out, see `iter_records`.
+        :param chunk_size: None or int;
+            Number of rows whose pages are kept in memory.
+        :raises ImportError: if `chunk_size` is given and pypdf is not
+            installed.
+
+        """
+        if chunk_size:
+            try:
+                import pypdf
+            except ImportError:
+                raise ImportError(
+                    "pypdf is needed to write the combined PDF file in "
+                    "chunks; install it, or pass chunk_size=None to keep "
+                    "all pages in memory") from None
+
+        with tempfile.TemporaryDirectory(prefix='formletter-') as temp_dir:
+            chunk_files = []
+            first_doc = None
+            pages = []
+            rows = 0
+            for i, (row, record) in enumerate(
+                    self.iter_records(indexes, skip)):
+                self.current_row = row
+                doc = self.render_html(self.fill_template(record))
+                if first_doc is None:
+                    first_doc = doc
+                pages.extend(doc.pages)
+                rows += 1
+                if callback is not None:
+                    callback(i + 1)
+                if chunk_size and rows >= chunk_size:
+                    chunk_files.append(os.path.join(
+                        temp_dir, '%i.pdf' % len(chunk_files)))
+                    with self._stage('write_pdf'):
+                        first_doc.copy(pages).write_pdf(chunk_files[-1])
+                    first_doc = None
+                    pages = []
+                    rows = 0
+            self.current_row = None
+            if not chunk_files:
+                if first_doc is None:
+                    raise ValueError("No rows to convert")
+                self._save_pdf(first_doc.copy(pages), file_name)
+                return
+
+            with self._stage('write_pdf'):
+                if first_doc is not None:
+                    chunk_files.append(os.path.join(
+                        temp_dir, '%i.pdf' % len(chunk_files)))
+                    first_doc.copy(pages).write_pdf(chunk_files[-1])
+                    first_doc = pages = None
+                writer = pypdf.PdfWriter()
+                for chunk_file in chunk_files:
+                    writer.append(chunk_file)
+                # the document metadata, e.g. its title, of the first row:
+                metadata = pypdf.PdfReader(chunk_files[0]).metadata
+                if metadata:
+                    writer.add_metadata(metadata)
+                if not self._writes_files():
+                    data = io.BytesIO()
+                    writer.write(data)
+            try:
+                if self._writes_files():
+                    # not through memory:
+                    with self._stage('write_file'):
+                        writer.write(file_name)
+                else:
+                    self._write_file(file_name, data.getvalue())
+            finally:
+                writer.close()
+
+    def write_batch_to_pdf(self, rows, file_names):
+        """Save the template, filled with the data of each of the
+        specified rows, as one PDF file per row, laying out all of them
+        in one single WeasyPrint pass. See `write_records_to_pdf`.
+
+        :param rows:
+            list of row numbers to convert. start counting at 0.
+        :param file_names: list of strings;
+            Destination file names, one for each row.
+
+        """
+        if rows:
+            self.current_row = rows[0]
+        self.write_records_to_pdf(
+            [self.get_data_row(row) for row in rows], file_names)
+
+    def write_records_to_pdf(self, records, file_names):
+        """Save the template, filled with the data of each of the
+        specified rows, as one PDF file per row, laying out all of them
+        in one single WeasyPrint pass.
+
+        This amortizes the fixed costs of WeasyPrint per document over
+        all rows, which pays off for short letters. The body contents of
+        the filled templates are joined in one document, each wrapped in
+        a `<div>` which starts on a new page. Afterwards, the pages are
+        split up again. Therefore, the head of the template must be the
+        same for all rows, CSS selectors must not depend on the body
+        being the direct parent of the content, and page counters and
+        `@page :first` rules will count over all rows of the batch.
+
+        :param records:
+            list of mappings of column names to values, one per row.
+        :param file_names: list of strings;
+            Destination file names, one for each row.
+
+        """
+        htmls = [self.fill_template(record) for record in records]
+        keys = [self._get_dedup_key(html) for html in htmls]
+        # only render the first of identical rows:
+        to_render = []
+        for i, key in enumerate(keys):
+            if key is None or (key not in self._dedup_files
+                               and key not in keys[:i]):
+                to_render.append(i)
+
+        if to_render:
+            doc = self.render_html(
+                self._join_html([htmls[i] for i in to_render]))
+            for i, pages in zip(
+                    to_render, self._split_pages(doc, len(to_render))):
+                self._save_pdf(doc.copy(pages), file_names[i])
+                self._remember_output(keys[i], file_names[i])
+        for i in set(range(len(records))) - set(to_render):
+            if not self._reuse_duplicate(keys[i], file_names[i]):
+                self._save_pdf(self.render_html(htmls[i]), file_names[i])
+                self._remember_output(keys[i], file_names[i])
+
+    @staticmethod
+    def _join_html(htmls):
+        parts = []
+        for i, html in enumerate(htmls):
+            match = _body_re.search(html)
+            if match is None:
+                raise ValueError(
+                    "Template has no <body> element, it cannot be "
+                    "rendered in batches")
+            if i == 0:
+                head = html[:match.start(1)]
+                tail = html[match.end(1):]
+            parts.append(
+                '<div id="%s" style="break-before: page">%s</div>' % (
+                    _batch_anchor % i, match.group(1)))
+        return head + ''.join(parts) + tail
+
+    @staticmethod
+    def _split_pages(doc, count):
+        """Return a list of lists of pages of `doc`, one for each of the
+        `count` rows joined by `_join_html`.
+        """
+        pages = [[] for i in range(count)]
+        current = 0
+        for page in doc.pages:
+            # the anchor of a row can only be found on its pages:
+            for i in range(current, count):
+                if _batch_anchor % i in page.anchors:
+                    current = i
+            pages[current].append(page)
+        if not all(pages):
+            raise ValueError("Could not split batch into rows")
+        return pages
+
+    def render_html(self, html):
+        """Lay out a HTML string, e.g. a filled template, with WeasyPrint.
+
+        The precompiled stylesheets (see `precompile_css` parameter of
+        the constructor) are removed from the html and the parsed
+        versions passed to WeasyPrint instead. WeasyPrint applies these
+        as user stylesheets, which lose against author styles and whose
+        `!important` declarations win against author ones. So they are
+        only used if this gives the same result, i.e. if no stylesheets
+        remain in the html, and no `!important` declarations either, in
+        case the precompiled ones might contain some. Otherwise, the html
+        is laid out as it is.
+
+        :param html: HTML-formatted string
+        :returns:
+            weasyprint.Document
+
+        """
+        import weasyprint
+        with self._stage('layout'):
+            if self.font_config is None:
+                self._init_weasyprint()
+            stylesheets = []
+            important = False
+            stripped = html
+            for tag, css, css_important in self.stylesheets:
+                if tag in stripped:
+                    stripped = stripped.replace(tag, '', 1)
+                    stylesheets.append(css)
+                    important = important or css_important
+            if stylesheets and self._keeps_cascade(stripped, important):
+                html = stripped
+            else:
+                stylesheets = []
+            return weasyprint.HTML(
+                string=html, base_url=self.base_url,
+                url_fetcher=self.url_fetcher).render(
+                    stylesheets=stylesheets, font_config=self.font_config)
+
+    @staticmethod
+    def _keeps_cascade(html, important):
+        """Return True if the precompiled stylesheets removed from `html`
+        can be applied as user stylesheets without changing the cascade,
+        see `render_html`.
+        """
+        if _style_re.search(html):
+            return False
+        if any(_stylesheet_rel_re.search(tag)
+               for tag in _link_re.findall(html)):
+            return False
+        return not (important and _important_re.search(html))
+
+    def _init_weasyprint(self):
+        self.font_config = _get_font_configuration()
+        if self.url_cache_size:
+            self.url_cache = CachingURLFetcher(self.url_cache_size)
+            self.url_fetcher = self.url_cache.get_url_fetcher()
+        self.stylesheets = []
+        if self.precompile_css:
+            self.stylesheets = self._compile_stylesheets()
+
+    def _compile_stylesheets(self):
+        """Find the static stylesheets in the template source and parse
+        them into weasyprint.CSS objects.
+
+        Stylesheets containing template syntax, or with a `media`
+        attribute, are left for WeasyPrint to handle per row.
+
+        :returns:
+            list of tuples (tag in html, weasyprint.CSS, bool telling
+            whether the stylesheet might contain `!important` rules)
+
+        """
+        import weasyprint
+        source = self.env.loader.get_source(
+            self.env, os.path.split(self.template_file)[1])[0]
+        stylesheets = []
+        # in document order, which decides between rules of the same
+        # specificity:
+        matches = sorted(
+            list(_style_re.finditer(source)) + list(_link_re.finditer(source)),
+            key=lambda match: match.start())
+        for match in matches:
+            tag = match.group(0)
+            if match.re is _style_re:
+                if (_jinja_syntax_re.search(tag)
+                        or _media_re.search(match.group(1))):
+                    continue
+                stylesheets.append((tag, weasyprint.CSS(
+                    string=match.group(2), base_url=self.base_url,
+                    url_fetcher=self.url_fetcher,
+                    font_config=self.font_config),
+                    bool(_important_re.search(match.group(2)))))
+                continue
+            href = _href_re.search(tag)
+            href = href and (href.group(1) or href.group(2))
+            if (not _stylesheet_rel_re.search(tag) or not href
+                    or _jinja_syntax_re.search(tag) or _media_re.search(tag)):
+                continue
+            url = urllib.parse.urljoin(self.base_url, href)
+            stylesheets.append((tag, weasyprint.CSS(
+                url=url, url_fetcher=self.url_fetcher,
+                font_config=self.font_config), self._might_be_important(url)))
+        return stylesheets
+
+    @staticmethod
+    def _might_be_important(url):
+        # remote stylesheets are not fetched again to find out:
+        if not url.startswith('file:'):
+            return True
+        path = urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                return bool(_important_re.search(f.read()))
+        except OSError:
+            return True
 
     def write_to_pdf_xhtml2pdf(self, row, file_name):
         """Save the template, filled with the data of the specified row,
@@ -181,34 +2624,741 @@ class FormLetter(object):
             pisa.CreatePDF(html, dest=f)
 
     def get_data_row(self, row):
-        return self.data.iloc[row]
+        """Return a dictionary mapping the column names to the values of
+        the specified row. start counting at 0.
+        """
+        return dict(zip(self.columns, self.rows[row]))
 
     def get_number_of_rows(self):
+        if self.data is None:
+            return None
         return self.data.shape[0]
 
+    def get_file_name(self, row, filename_pattern, record=None, first_row=1):
+        """Return the output file name for the specified row.
+
+        :param row:
+            the row number of data. start counting at 0.
+        :param filename_pattern: string;
+            Pattern for `str.format`. Special extra keyword is '{row}',
+            the row number starting at `first_row`, or use any column
+            name supplied with the data, e.g. '{row:04}_{Person}.pdf'.
+        :param record:
+            the data of the row. If None (default), it is looked up.
+        :param first_row: int;
+            The number of the first row in '{row}', 1 (default) as in the
+            GUI, or 0 as in the file names of the command line tool.
+        :returns:
+            file name string
+
+        """
+        if record is None:
+            record = self.get_data_row(row)
+        return filename_pattern.format(row=row + first_row, **record)
+
+    def get_template_hash(self):
+        """Return a hash over the template source, the templates it
+        includes or extends, and the local files (stylesheets, images,
+        fonts) referenced by them or by referenced stylesheets, and the
+        settings changing the output: the locales of the formatters, the
+        `precompile_css` option and the WeasyPrint version.
+        """
+        import importlib.metadata
+        try:
+            weasyprint_version = importlib.metadata.version('weasyprint')
+        except importlib.metadata.PackageNotFoundError:
+            weasyprint_version = None
+        settings = dict(
+            locales=[str(locale) for locale in
+                     Formatters(self.locale).get_locales()],
+            precompile_css=self.precompile_css,
+            weasyprint=weasyprint_version)
+        h = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        seen = set()
+        for source, _ in self._iter_template_sources():
+            h.update(source.encode('utf-8'))
+            self._hash_assets(h, source, self.base_url, seen)
+        return h.hexdigest()
+
+    def _hash_assets(self, h, source, base_url, seen):
+        for match in _asset_re.finditer(source):
+            url = urllib.parse.urljoin(
+                base_url, (match.group(1) or match.group(2)).strip())
+            if not url.startswith('file:') or url in seen:
+                continue
+            seen.add(url)
+            path = urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            h.update(url.encode('utf-8'))
+            h.update(content)
+            if path.lower().endswith('.css'):
+                self._hash_assets(
+                    h, content.decode('utf-8', 'replace'), url, seen)
+
+    def open_manifest(self, directory, name='formletter_manifest.json'):
+        """Return a `RenderManifest` for incremental runs writing into
+        `directory`, for the current template.
+        """
+        return RenderManifest(
+            os.path.join(directory, name), self.get_template_hash())
+
+    def iter_render_batch(self, indexes, filename_pattern, jobs=1,
+                          destdir='', layout_batch_size=1, skip=None,
+                          manifest=None, first_row=1, cancel=None):
+        """Save the template, filled with the data of each of the
+        specified rows, as PDF files, using `jobs` processes.
+
+        Each worker process creates its own FormLetter instance (and thus
+        its own jinja2 environment and WeasyPrint state) once and then
+        renders all rows it is given. The rows are read lazily, so this
+        also works in streaming mode. The workers are not forked from
+        this process (see `_get_mp_context`), so scripts using them need
+        an `if __name__ == '__main__':` guard.
+
+        :param indexes:
+            iterable of row numbers to convert. start counting at 0.
+            If None, all rows are converted.
+        :param filename_pattern: string;
+            Destination file name pattern, see `get_file_name`.
+        :param jobs: int or None;
+            Number of worker processes. If 1 (default), all rows will
+            be rendered in this process. If None, the number of CPUs
+            will be used.
+        :param destdir: string;
+            Directory the file names will be joined to.
+        :param layout_batch_size: int;
+            If larger than 1 (default), this many rows are laid out
+            together in one WeasyPrint pass, see `write_batch_to_pdf`
+            for its requirements on the template. If one row of a batch
+            fails, the error is reported for all rows of the batch.
+        :param skip: None or function;
+            Rows to leave out, see `iter_records`.
+        :param manifest: None or RenderManifest;
+            If given, rows whose output file is up to date according to
+            the manifest are left out, and the manifest is updated with
+            the newly rendered files. See `open_manifest`.
+        :param first_row: int;
+            The number of the first row in the file names, see
+            `get_file_name`.
+        :param cancel: None or threading.Event;
+            If given and set, e.g. by another thread, the iteration ends
+            after the row being rendered in this process, or right away
+            with worker processes, which are terminated.
+        :yields:
+            a tuple (row, file_name, error) for each row, as soon as it
+            is finished; `error` is None on success or the exception
+            raised while rendering that row. Rows may be yielded out of
+            order if `jobs` > 1. If the generator is closed before it is
+            exhausted, e.g. to cancel the conversion, the rows in flight
+            are abandoned and the worker processes terminated.
+
+        """
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        tasks = ((row, os.path.join(
+                      destdir,
+                      self.get_file_name(
+                          row, filename_pattern, record, first_row)),
+                  record)
+                 for row, record in self.iter_records(indexes, skip))
+        if manifest is None:
+            yield from self._iter_render_tasks(
+                tasks, jobs, layout_batch_size, cancel)
+            return
+
+        # rows laid out together share e.g. page counters:
+        settings = dict(layout_batch_size=layout_batch_size)
+        tasks = (task for task in tasks
+                 if not manifest.is_up_to_date(task[1], task[2], settings))
+        try:
+            for row, file_name, error in self._iter_render_tasks(
+                    tasks, jobs, layout_batch_size, cancel):
+                if error is None:
+                    # the manifest hashes the written file:
+                    error = self.wait_for_file(file_name)
+                if error is None:
+                    manifest.add(file_name)
+                yield row, file_name, error
+        finally:
+            manifest.save()
+
+    def _iter_render_tasks(self, tasks, jobs, layout_batch_size, cancel=None):
+        """Render tuples (row, file_name, record), see
+        `iter_render_batch`.
+        """
+        # lists of up to `layout_batch_size` tasks:
+        chunks = iter(
+            lambda: list(itertools.islice(tasks, layout_batch_size)), [])
+
+        if jobs <= 1:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    return
+                yield from self._render_tasks(chunk)
+            return
+
+        def wait_for_first(pending):
+            # the finished futures, or None if cancelled while waiting:
+            while True:
+                done, _ = wait(pending, None if cancel is None else 0.1,
+                               FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    return None
+                if done:
+                    return done
+
+        collect_output = self.output is not None
+        writes_files = self._writes_files()
+        with ProcessPoolExecutor(
+                max_workers=jobs, mp_context=_get_mp_context(),
+                initializer=_init_worker,
+                initargs=(self._init_args, self._init_kwargs)) as executor:
+            # Only keep a limited number of tasks in flight, so huge
+            # `indexes` don't pile up in the executor's queue:
+            pending = {}
+            # files written in this run, and the copies of duplicates
+            # waiting for their source, see `_get_worker_result`:
+            written = set()
+            deferred = {}
+            try:
+                for chunk in itertools.chain(chunks, [None]):
+                    # after the last chunk, wait for all pending ones:
+                    while pending and (chunk is None
+                                       or len(pending) >= 2 * jobs):
+                        done = wait_for_first(pending)
+                        if done is None:
+                            _terminate_executor(executor)
+                            return
+                        for future in done:
+                            yield from self._get_worker_result(
+                                future, pending.pop(future), written,
+                                deferred)
+                    if chunk is None:
+                        break
+                    future = executor.submit(
+                        _render_worker, chunk, bool(self.observers),
+                        collect_output, writes_files)
+                    pending[future] = chunk
+                # the sources of these were never written, e.g. because
+                # rendering them failed:
+                for copies in deferred.values():
+                    for row, file_name, record in copies:
+                        yield row, file_name, self._copy_duplicate(
+                            None, row, file_name, record)
+            except BaseException:
+                # the iteration was stopped early, e.g. closed when
+                # cancelled by the user: don't wait for the rows in flight
+                _terminate_executor(executor)
+                raise
+
+    def render_batch(self, indexes, filename_pattern, jobs=1, destdir='',
+                     layout_batch_size=1, skip=None, manifest=None,
+                     first_row=1):
+        """Save the template, filled with the data of each of the
+        specified rows, as PDF files, using `jobs` processes.
+
+        See `iter_render_batch` for the parameters.
+
+        :returns:
+            list of tuples (row, file_name, error), sorted by row.
+
+        """
+        return sorted(
+            self.iter_render_batch(
+                indexes, filename_pattern, jobs, destdir, layout_batch_size,
+                skip, manifest, first_row),
+            key=lambda result: result[0])
+
+    async def render_stream(self, indexes=None, jobs=1, max_in_flight=None,
+                            skip=None, locale=None):
+        """Render the template, filled with the data of each of the
+        specified rows, to PDF file contents in an executor, and yield
+        them as they are finished, for use in asyncio code, e.g.
+
+            async for row, pdf, error in fl.render_stream(rows, jobs=4):
+                await upload(row, pdf)
+
+        Only `max_in_flight` rows are rendered or waiting to be rendered
+        at a time; further rows are only submitted after the caller took
+        finished ones, so a slow consumer slows down the rendering
+        instead of piling up PDF files in memory.
+
+        :param indexes:
+            iterable of row numbers to convert. start counting at 0.
+            If None, all rows are converted.
+        :param jobs: int or None;
+            Number of worker processes, see `iter_render_batch`. If 1
+            (default) or less, the rows are rendered by this instance in
+            a background thread. If None, the number of CPUs will be used.
+        :param max_in_flight: None or int;
+            Maximum number of rows submitted to the executor and not yet
+            taken by the caller, at least 1. If None (default), twice
+            `jobs`.
+        :param skip: None, function, string or boolean array;
+            Rows to leave out, see `iter_records`.
+        :param locale: None or locale identifier, see `get_filled_html`.
+        :yields:
+            a tuple (row, pdf, error) for each row, as soon as it is
+            finished; `pdf` is the content of the PDF file (bytes), or
+            None if rendering the row raised the exception `error`.
+            Rows may be yielded out of order. If the generator is closed
+            before it is exhausted, the rows in flight are abandoned and
+            the worker processes terminated.
+
+        """
+        loop = asyncio.get_running_loop()
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = max(jobs, 1)
+        if max_in_flight is None:
+            max_in_flight = 2 * jobs
+        elif max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1, not %r"
+                             % max_in_flight)
+        # reads the data in streaming mode and, with one job, renders the
+        # rows, so this instance is only used by one thread at a time:
+        thread = ThreadPoolExecutor(max_workers=1)
+        processes = None
+        if jobs > 1:
+            processes = ProcessPoolExecutor(
+                max_workers=jobs, mp_context=_get_mp_context(),
+                initializer=_init_worker,
+                initargs=(self._init_args, self._init_kwargs))
+        records = self.iter_records(indexes, skip)
+        pending = {}
+        finished = False
+        try:
+            while True:
+                while len(pending) < max_in_flight:
+                    if self.data is None:
+                        item = await loop.run_in_executor(
+                            thread, next, records, None)
+                    else:
+                        item = next(records, None)
+                    if item is None:
+                        break
+                    row, record = item
+                    if processes is None:
+                        future = loop.run_in_executor(
+                            thread, self._get_row_pdf, row, record, locale)
+                    else:
+                        future = loop.run_in_executor(
+                            processes, _pdf_worker, row, record, locale,
+                            bool(self.observers))
+                    pending[future] = row
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    row = pending.pop(future)
+                    yield (row,) + self._get_stream_result(
+                        future, processes is not None)
+            finished = True
+        finally:
+            for future in pending:
+                future.cancel()
+            thread.shutdown(wait=False, cancel_futures=True)
+            if processes is not None and finished:
+                processes.shutdown(wait=False)
+            elif processes is not None:
+                _terminate_executor(processes)
+
+    def _get_row_pdf(self, row, record, locale=None):
+        self.current_row = row
+        return self.get_record_pdf(record, locale)
+
+    def _get_stream_result(self, future, from_worker):
+        """Return a tuple (pdf, error) for a finished future of
+        `render_stream`.
+        """
+        try:
+            result = future.result()
+        except Exception as e:
+            return None, e
+        if not from_worker:
+            return result, None
+        pdf, (pid, stats), events = result
+        self._worker_stats[pid] = stats
+        for event in events:
+            self._notify(*event)
+        return pdf, None
+
+    def _render_tasks(self, tasks):
+        """Render a list of tuples (row, file_name, record), in one layout
+        pass if there is more than one, and return a list of the results.
+        """
+        self.current_row = tasks[0][0]
+        try:
+            if len(tasks) == 1:
+                self.write_record_to_pdf(tasks[0][2], tasks[0][1])
+            else:
+                self.write_records_to_pdf(
+                    [record for _, _, record in tasks],
+                    [file_name for _, file_name, _ in tasks])
+        except Exception as e:
+            return [(row, file_name, e) for row, file_name, _ in tasks]
+        return [(row, file_name, None) for row, file_name, _ in tasks]
+
+    def _get_worker_result(self, future, tasks, written, deferred):
+        """Return the results of the finished worker `future` rendering
+        `tasks`, see `_iter_render_tasks`, and write the files it
+        rendered to memory.
+
+        Copies of duplicates are only made from files in the set
+        `written` of the files written in this run, as results arrive in
+        any order and an older file of the same name may exist. Others
+        are put into `deferred`, a dict of lists of tasks by the source
+        file name, and their results are returned with the source's.
+        """
+        try:
+            results, (pid, stats), events, files = future.result()
+        except Exception as e:
+            # e.g. a crashed worker process or an exception that could
+            # not be pickled:
+            return [(row, file_name, e) for row, file_name, _ in tasks]
+        self._worker_stats[pid] = stats
+        for event in events:
+            self._notify(*event)
+        if files is None:
+            return results
+        # the worker rendered to memory, write the files to the output:
+        tasks = {file_name: (row, record) for row, file_name, record in tasks}
+        errors = {}
+        for file_name, data in files.files:
+            self.current_row = tasks[file_name][0]
+            try:
+                self._write_file(file_name, data)
+            except Exception as e:
+                errors[file_name] = e
+            else:
+                written.add(file_name)
+        waiting = set()
+        for source, file_name in files.copies:
+            row, record = tasks[file_name]
+            if source in written:
+                errors[file_name] = self._copy_duplicate(
+                    source, row, file_name, record)
+            else:
+                deferred.setdefault(source, []).append(
+                    (row, file_name, record))
+                waiting.add(file_name)
+        results = [(row, file_name, error or errors.get(file_name))
+                   for row, file_name, error in results
+                   if file_name not in waiting]
+        # copies waiting for the files written now:
+        for source, _ in files.files:
+            for row, file_name, record in deferred.pop(source, []):
+                results.append((row, file_name, self._copy_duplicate(
+                    source if source in written else None,
+                    row, file_name, record)))
+        return results
+
+    def _copy_duplicate(self, source, row, file_name, record):
+        """Copy the file `source` to `file_name`, or render `record` into
+        it if that is not possible (or `source` is None), and return the
+        exception raised, or None.
+        """
+        self.current_row = row
+        try:
+            if source is None or not self._copy_file(source, file_name):
+                self.write_record_to_pdf(record, file_name)
+        except Exception as e:
+            return e
+        return None
+
+    def add_observer(self, observer):
+        """Add a function to be called after every stage of the
+        processing, see `observers` parameter of the constructor.
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def _notify(self, stage, row, seconds):
+        for observer in self.observers:
+            observer(stage, row, seconds)
+
+    @contextlib.contextmanager
+    def _stage(self, stage):
+        """Report the time spent in the with-block as `stage` of
+        `current_row` to the observers.
+        """
+        if not self.observers:
+            yield
+            return
+        row = self.current_row
+        start = time.perf_counter()
+        yield
+        self._notify(stage, row, time.perf_counter() - start)
+
+    def _get_own_stats(self):
+        stats = {}
+        if self.url_cache is not None:
+            stats['url_cache_hits'] = self.url_cache.hits
+            stats['url_cache_misses'] = self.url_cache.misses
+        if self.dedup:
+            stats['dedup_saved'] = self.dedup_saved
+        return stats
+
+    def get_stats(self):
+        """Return a dictionary of counters, e.g. 'url_cache_hits', summed
+        over this instance and its worker processes.
+        """
+        stats = self._get_own_stats()
+        for worker_stats in self._worker_stats.values():
+            for key, value in worker_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+def _get_file_hash(file_name):
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _get_column_names(header):
+    """Return column names for a header row read with openpyxl, named
+    like pandas does for empty header cells.
+    """
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    return [("Unnamed: %i" % i) if name is None else str(name)
+            for i, name in enumerate(header)]
+
+
+def _has_pypdf():
+    """Return True if pypdf, needed for `FormLetter.write_all_to_pdf`, is
+    installed, without importing it.
+    """
+    import importlib.util
+    return importlib.util.find_spec('pypdf') is not None
+
+
+def _get_mp_context():
+    """Return the multiprocessing context to start worker processes
+    with. Not 'fork', the default on Linux, since forking a process with
+    threads (e.g. of a `BackgroundWriter` or the GUI) can deadlock.
+    """
+    import multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _terminate_executor(executor):
+    """Cancel the pending tasks of a ProcessPoolExecutor and terminate
+    its worker processes, without waiting for the running tasks.
+    """
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+# FormLetter instance of a worker process, see `FormLetter.iter_render_batch`:
+_worker_formletter = None
+
+def _init_worker(args, kwargs):
+    global _worker_formletter
+    _worker_formletter = FormLetter(*args, **kwargs)
+
+def _render_worker(tasks, collect_events=False, collect_output=False,
+                   writes_files=True):
+    # the observers and the output of the parent cannot be sent to the
+    # worker, so the events and files are collected and sent back with
+    # the results:
+    events = []
+    if collect_events:
+        _worker_formletter.observers = [
+            lambda *event: events.append(event)]
+    else:
+        _worker_formletter.observers = []
+    files = _CollectingOutput(writes_files) if collect_output else None
+    _worker_formletter.output = files
+    results = _worker_formletter._render_tasks(tasks)
+    if collect_output:
+        # the files are written (and timed) by the parent:
+        events = [event for event in events if event[0] != 'write_file']
+    return (results, (os.getpid(), _worker_formletter._get_own_stats()),
+            events, files)
+
+def _pdf_worker(row, record, locale=None, collect_events=False):
+    # see `FormLetter.render_stream`:
+    events = []
+    if collect_events:
+        _worker_formletter.observers = [
+            lambda *event: events.append(event)]
+    else:
+        _worker_formletter.observers = []
+    _worker_formletter.current_row = row
+    pdf = _worker_formletter.get_record_pdf(record, locale)
+    return (pdf, (os.getpid(), _worker_formletter._get_own_stats()),
+            events)
+
+
+# output file names of the command line tool, with the row number
+# starting at 0:
+_filename_pattern = "pdf{row:02}_{RN}_{Person}.pdf"
+
 def main(argv=sys.argv[1:]):
-    if len(argv) < 2:
-        print("usage: python Formletter.py templatefile.html datafile.xlsx "
-              "[sheet_name]")
+    parser = argparse.ArgumentParser(
+        prog="FormLetter.py",
+        description="Generate PDF files from a HTML template, filled "
+                    "with the data of each row of a table.")
+    parser.add_argument("templatefile", help="template file (.html)")
+    parser.add_argument("datafile",
+                        help="data file (.xlsx, .csv, .parquet, .feather, "
+                             ".db) or sqlite:///file.db?table=NAME")
+    parser.add_argument("sheet_name", nargs="?", default=None,
+                        help="sheet name of excel data file or table name "
+                             "of SQLite database")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of parallel processes (default: 1); "
+                             "0 means one per CPU")
+    parser.add_argument("--layout-batch-size", type=int, default=1,
+                        metavar="K",
+                        help="lay out K rows in one pass and split the "
+                             "pages afterwards (default: 1)")
+    parser.add_argument("--chunksize", type=int, default=None, metavar="N",
+                        help="stream the data file in chunks of N rows "
+                             "instead of loading it at once")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only convert rows whose output file is "
+                             "missing or out of date, according to the "
+                             "manifest written by previous runs")
+    parser.add_argument("--dedup", nargs="?", const="copy",
+                        choices=["copy", "link"],
+                        help="do not render identical letters again, but "
+                             "copy (default) or hard link the first file")
+    parser.add_argument("--locale", default=None,
+                        help="locale for the formatters in the template, "
+                             "e.g. de_DE (default: system locale)")
+    parser.add_argument("--skip", metavar="EXPR",
+                        default="`1_wenn_RN_verschickt` != 0",
+                        help="skip the rows for which this expression over "
+                             "the columns is true, e.g. 'Status == \"sent\" "
+                             "or Amount <= 0' (default: '%(default)s'); "
+                             "use '' to convert all rows")
+    parser.add_argument("--combined", metavar="FILE",
+                        help="write all letters into this single PDF file "
+                             "instead of one file per row (needs pypdf)")
+    parser.add_argument("--archive", metavar="FILE",
+                        help="write the PDF files into this ZIP or tar "
+                             "archive (.zip, .tar, .tar.gz, .tar.bz2, "
+                             ".tar.xz) instead of single files")
+    parser.add_argument("--writer-threads", type=int, default=1,
+                        metavar="N",
+                        help="write the files in N background threads "
+                             "while rendering (default: 1); 0 writes "
+                             "them right away")
+    parser.add_argument("--fsync", action="store_true",
+                        help="flush each file to the disk")
+    parser.add_argument("--no-atomic", dest="atomic", action="store_false",
+                        help="write the files directly instead of under "
+                             "a temporary name, renamed when complete")
+    parser.add_argument("--no-data-cache", dest="data_cache",
+                        action="store_false",
+                        help="always parse the data file instead of using "
+                             "the parsed data cached by an earlier run")
+    parser.add_argument("--profile", nargs="?", metavar="FILE",
+                        const="formletter_profile.json",
+                        help="print the time spent in each stage and write "
+                             "it as JSON to FILE (default: "
+                             "formletter_profile.json)")
+    args = parser.parse_args(argv)
+    args.skip = args.skip or None
+    if args.archive and (args.incremental or args.dedup):
+        parser.error("--archive can not be used with --incremental "
+                     "or --dedup")
+    if args.combined and not _has_pypdf():
+        parser.error("--combined needs pypdf, install it with "
+                     "'pip install pypdf'")
+
+    print('using template file: %s' % args.templatefile)
+    print('using data file: %s' % args.datafile)
+    if args.sheet_name is not None:
+        print('using sheet name: %s' % args.sheet_name)
+    profiler = StageProfiler() if args.profile else None
+    fl = FormLetter(args.templatefile, args.datafile, args.sheet_name,
+                    chunksize=args.chunksize, dedup=args.dedup or False,
+                    locale=args.locale,
+                    observers=[profiler] if profiler else None,
+                    usecols=FormLetter.get_pattern_fields(_filename_pattern)
+                            + FormLetter.get_expression_fields(args.skip or ""),
+                    data_cache=args.data_cache)
+    archive = ArchiveWriter(args.archive) if args.archive else None
+    fl.output = BackgroundWriter(
+        archive, threads=args.writer_threads, fsync=args.fsync,
+        atomic=args.atomic, observers=fl.observers)
+    try:
+        _convert(fl, args)
+    finally:
+        fl.output.close()
+        for fname, error in fl.output.errors.items():
+            print("ERROR writing file %s: %s" % (fname, error))
+        if archive is not None:
+            print("%i files written to archive %s" % (
+                archive.count, args.archive))
+        if profiler is not None:
+            print(profiler.report())
+            profiler.save(args.profile)
+            print("profile written to %s" % args.profile)
+
+
+def _convert(fl, args):
+    skip = args.skip
+    indexes = None
+    if fl.data is not None:
+        # select the rows at once, so skipped rows are never visited:
+        indexes = fl.select_rows(None, skip)
+        skip = None
+        print("skipping %i of %i rows" % (
+            fl.get_number_of_rows() - len(indexes),
+            fl.get_number_of_rows()))
+
+    if args.combined:
+        try:
+            fl.write_all_to_pdf(
+                indexes, args.combined, skip=skip,
+                callback=lambda n: print("processed %i" % n))
+        except ValueError as e:
+            print(e)
+            return
+        print("written file %s" % args.combined)
         return
-    print('using template file: %s' % argv[0])
-    print('using data file: %s' % argv[1])
-    if len(argv) > 2:
-        print('using sheet name: %s' % argv[2])
-        fl = FormLetter(argv[0], argv[1], argv[2])
-    else:
-        fl = FormLetter(argv[0], argv[1])
-
-    total = fl.get_number_of_rows()
-    for i in range(total):
-        row = fl.get_data_row(i)
-        if row["1_wenn_RN_verschickt"]:
-            print("skipping %i/%i: %s %s" % (i + 1, total, row["RN"], row["Person"]))
-            continue
-        fname = "pdf%02i_%s_%s.pdf" % (i, row["RN"], row["Person"])
-        print("processing %i/%i: file %s" % (i + 1, total, fname))
-        fl.write_to_pdf(i, fname)
-        #fl.write_to_pdf_xhtml2pdf(i, fname)
+
+    manifest = fl.open_manifest(os.curdir) if args.incremental else None
+    failed = 0
+    results = fl.iter_render_batch(
+        indexes, _filename_pattern, jobs=args.jobs or None,
+        layout_batch_size=args.layout_batch_size, skip=skip,
+        manifest=manifest, first_row=0)
+    for i, (rownum, fname, error) in enumerate(results):
+        if error is None:
+            print("processed %i (data row %i): file %s" % (
+                i + 1, rownum + 1, fname))
+        else:
+            failed += 1
+            print("ERROR in data row %i: file %s: %s" % (
+                rownum + 1, fname, error))
+    if failed:
+        print("%i files could not be created" % failed)
+    if manifest is not None:
+        print("%i files unchanged" % manifest.unchanged)
+    stats = fl.get_stats()
+    if 'url_cache_hits' in stats:
+        print("resource cache: %i hits, %i misses" % (
+            stats['url_cache_hits'], stats['url_cache_misses']))
+    if 'dedup_saved' in stats:
+        print("%i renders saved by deduplication" % stats['dedup_saved'])
 
 
 
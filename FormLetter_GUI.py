@@ -12,7 +12,6 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
-import pandas as pd
 from threading import Thread, Event
 import queue
 import time
@@ -59,9 +58,12 @@ class Application(tk.Frame):
         self.num_to_convert = 0
         self.create_widgets()
         self.sheet_name = self.sheet_names = None
-        self.xlbook = None
+        # FormLetter.DataSource of the data file:
+        self.source = None
         self.data = None
         self.datafilename = None
+        # number of files or sheets being loaded in the background:
+        self.loading = 0
 
     def create_widgets(self):
         self.ttkstyle = ttk.Style()
@@ -107,7 +109,7 @@ class Application(tk.Frame):
         topframe = tk.Frame(fileframe, pady=5, padx=0)
         topframe.pack(side=tk.TOP, fill=tk.X, expand=0)
 
-        tk.Label(topframe, text="Data file (*.xlsx / *.csv): ").pack(side=tk.LEFT)
+        tk.Label(topframe, text="Data file (*.xlsx / *.csv / ...): ").pack(side=tk.LEFT)
         self.datafile_edt = ttk.Entry(topframe, width=1)
         self.datafile_edt.pack(side=tk.LEFT, fill=tk.X, expand=1, ipady=2)
         self.datafile_edt.bind('<Return>', self.datafile_edt_return)
@@ -121,6 +123,9 @@ class Application(tk.Frame):
                 state='disabled', style="custom.TCombobox")
         self.sheets_combo.pack(side=tk.LEFT, fill=tk.X, expand=1, ipady=2)
         self.sheets_combo.bind('<<ComboboxSelected>>', self.update_sheet)
+        # shown while the data is loaded:
+        self.loading_lbl = tk.Label(topframe, text="", width=10)
+        self.loading_lbl.pack(side=tk.LEFT)
 
 
         tk.Label(self, text="").pack(side=tk.TOP)
@@ -130,19 +135,40 @@ class Application(tk.Frame):
         frame.pack(side=tk.TOP, fill=tk.X, expand=0)
 
         self.ttkstyle.configure("TCheckbutton", background=frame["background"])
+        optframe = tk.Frame(frame, pady=0, padx=0)
+        optframe.pack(side=tk.TOP, fill=tk.X, expand=0)
         self.skip_var = tk.IntVar(0)
         ttk.Checkbutton(
-            frame, text=" Skip dataset if ", command=self.on_skipcheck,
+            optframe, text=" Skip dataset if ", command=self.on_skipcheck,
             var=self.skip_var).pack(side=tk.LEFT)
         self.skip_combo = ttk.Combobox(
-                frame, values=[], width=1,
+                optframe, values=[], width=1,
                 state='disabled', style="custom.TCombobox")
         self.skip_combo.pack(
                 side=tk.LEFT, fill=tk.X, expand=1, ipady=2, pady=5)
-        tk.Label(frame, text=" equals ").pack(side=tk.LEFT)
-        self.skip_edt = ttk.Entry(frame, width=1, state='disabled')
+        tk.Label(optframe, text=" equals ").pack(side=tk.LEFT)
+        self.skip_edt = ttk.Entry(optframe, width=1, state='disabled')
         self.skip_edt.pack(side=tk.LEFT, fill=tk.X, expand=1, ipady=2)
 
+        optframe = tk.Frame(frame, pady=0, padx=0)
+        optframe.pack(side=tk.TOP, fill=tk.X, expand=0)
+        self.incremental_var = tk.IntVar(0)
+        ttk.Checkbutton(
+            optframe, text=" Only convert datasets which changed since "
+                           "the last run (incremental)",
+            var=self.incremental_var).pack(side=tk.LEFT)
+
+        optframe = tk.Frame(frame, pady=0, padx=0)
+        optframe.pack(side=tk.TOP, fill=tk.X, expand=0)
+        tk.Label(optframe, text="Number of parallel processes: ").pack(
+            side=tk.LEFT)
+        cpu_count = os.cpu_count() or 1
+        self.jobs_spinbox = tk.Spinbox(
+                optframe, from_=1, to=4 * cpu_count, width=4, bg='white')
+        self.jobs_spinbox.pack(side=tk.LEFT, pady=5)
+        self.jobs_spinbox.delete(0, tk.END)
+        self.jobs_spinbox.insert(0, cpu_count)
+
 
 
         tk.Label(self, text="").pack(side=tk.TOP)
@@ -207,6 +233,20 @@ class Application(tk.Frame):
         self.convert_selection_entry.bind("<Key>", self.select_r3)
         self.conversion_selection_var.set(1)
 
+        tk.Label(frame, text="").grid(row=6)
+        self.combined_var = tk.IntVar(0)
+        ttk.Checkbutton(
+            frame, text=" Write all into one single pdf-file "
+                        "(output file name is used as is)",
+            var=self.combined_var).grid(
+                row=7, column=0, sticky='w', columnspan=4)
+        self.archive_var = tk.IntVar(0)
+        ttk.Checkbutton(
+            frame, text=" Write all pdf-files into one zip-archive "
+                        "instead of the folder (folder name + .zip)",
+            var=self.archive_var).grid(
+                row=8, column=0, sticky='w', columnspan=4)
+
 
 
         tk.Label(self, text="").pack(side=tk.TOP)
@@ -264,43 +304,119 @@ class Application(tk.Frame):
 
     def open_data_dialog(self):
         fname = filedialog.askopenfilename(
-            filetypes=[('Excel files', '*.xlsx *.xls *.csv'), ('all files', '*.*')])
+            filetypes=[('Excel files', '*.xlsx *.xls *.ods *.csv'),
+                       ('Parquet / Feather files',
+                        '*.parquet *.pq *.feather *.arrow'),
+                       ('SQLite databases', '*.db *.sqlite *.sqlite3'),
+                       ('all files', '*.*')])
         if fname:
             self.datafile_edt.delete(0, tk.END)
             self.datafile_edt.insert(0, fname)
             self.open_data_file(fname)
 
-    def open_data_file(self, fname, keep_selected_sheet=False):
+    def run_in_background(self, func, args, on_done):
+        """Call `func(*args)` in a background thread, so the window
+        stays responsive, and then `on_done` with its result in the main
+        thread. A loading indicator is shown in the meantime.
+        """
+        result = {}
+
+        def target():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+
+        thread = Thread(target=target, daemon=True)
+        thread.start()
+        self.loading += 1
+        self.loading_lbl["text"] = "loading..."
+        self.master.config(cursor="watch")
+
+        def poll():
+            if thread.is_alive():
+                self.master.after(50, poll)
+                return
+            self.loading -= 1
+            if not self.loading:
+                self.loading_lbl["text"] = ""
+                self.master.config(cursor="")
+            if 'error' in result:
+                messagebox.showerror(
+                    "Error", "Could not load data: %s" % result['error'])
+            else:
+                on_done(result['value'])
+
+        poll()
+
+    def open_data_file(self, fname, keep_selected_sheet=False,
+                       on_loaded=None):
+        """Load the data file `fname` in the background, then update
+        the widgets and call `on_loaded`, if given.
+        """
         self.datafilename = fname
-        ext = os.path.splitext(fname)[-1]
-        if ext in ['.xlsx', '.xls']:
-            # open excel file
-            self.xlbook = pd.ExcelFile(fname)
-            self.sheet_names = self.xlbook.sheet_names
-            self.sheets_combo.config(state='readonly')
-            self.sheets_combo["values"] = self.sheet_names
-            if (keep_selected_sheet
-                and self.sheet_name is not None
-                and self.sheet_name in self.sheet_names):
+        sheet_name = self.sheet_name if keep_selected_sheet else None
+        # (stays None if loading fails)
+        self.data = None
+
+        def loaded(result):
+            if fname != self.datafilename:
+                # another file was chosen in the meantime
+                return
+            self.source, self.sheet_names, self.sheet_name, data = result
+            if self.sheet_names is not None:
+                self.sheets_combo.config(state='readonly')
+                self.sheets_combo["values"] = self.sheet_names
                 self.sheets_combo.set(self.sheet_name)
             else:
-                # choose first sheet:
-                self.sheets_combo.current(newindex=0)
-            self.update_sheet()
-        else:
-            self.sheets_combo.set("")
-            self.sheets_combo.config(state='disabled')
-            self.sheets_combo["values"] = []
-            self.xlbook = None
-            self.sheet_names = self.sheet_name = None
-            try:
-                self.data = pd.read_csv(fname)
-                self.clean_up_data()
-                self.update_data_columns()
-            except pd.errors.ParserError as pe:
-                print("unknown data file format")
-                raise pe
+                self.sheets_combo.set("")
+                self.sheets_combo.config(state='disabled')
+                self.sheets_combo["values"] = []
+            self.set_data(data)
+            if on_loaded is not None:
+                on_loaded()
+
+        self.run_in_background(
+            self.read_data_file, (fname, sheet_name), loaded)
+
+    @staticmethod
+    def read_data_file(fname, sheet_name=None):
+        """Parse the data file `fname`, in any format supported by
+        FormLetter; for files with sheets (e.g. excel files or SQLite
+        databases), the sheet `sheet_name`, or the first one if it does
+        not exist. Parsed sheets are cached, see `FormLetter.DataCache`.
+
+        :returns:
+            tuple (FormLetter.DataSource, list of sheet names or None,
+            sheet name or None, data)
+        """
+        source = FormLetter.get_data_source(fname)
+        sheet_names = source.get_sheet_names()
+        if sheet_names is not None and sheet_name not in sheet_names:
+            # choose first sheet:
+            sheet_name = sheet_names[0]
+        elif sheet_names is None:
+            sheet_name = None
+        return (source, sheet_names, sheet_name,
+                FormLetter.load_data(source, sheet_name))
+
+    def update_sheet(self, event=None):
+        #if event is not None:
+        #    event.widget.selection_clear()
+        self.sheet_name = sheet_name = self.sheets_combo.get()
+        source = self.source
 
+        def loaded(data):
+            if source is self.source and sheet_name == self.sheet_name:
+                self.set_data(data)
+
+        self.run_in_background(
+            FormLetter.load_data, (source, sheet_name), loaded)
+
+    def set_data(self, data):
+        self.data = data
+        self.clean_up_data()
+        self.update_data_columns()
 
         self.convert_from_spinbox["to"] = self.data.shape[0]
         self.convert_from_spinbox.delete(0, tk.END)
@@ -309,14 +425,6 @@ class Application(tk.Frame):
         self.convert_to_spinbox.delete(0, tk.END)
         self.convert_to_spinbox.insert(0, self.data.shape[0])
 
-    def update_sheet(self, event=None):
-        #if event is not None:
-        #    event.widget.selection_clear()
-        self.sheet_name = self.sheets_combo.get()
-        self.data = self.xlbook.parse(self.sheet_name)
-        self.clean_up_data()
-        self.update_data_columns()
-
     def clean_up_data(self):
         # drop emtpy lines (where all values are nan):
         self.data = self.data.dropna(axis=0, how='all')
@@ -410,6 +518,7 @@ class Application(tk.Frame):
             self.go_button["style"] = 'custom.TButton'
             self.go_button["text"] = "Go!"
             self.go_button["command"] = self.run_conversion
+            self.go_button.state(['!disabled'])
 
     def check_queue(self):
         last = None
@@ -419,14 +528,25 @@ class Application(tk.Frame):
             except queue.Empty:
                 pass
         if last:
-            self.progressbar["value"] = last
-            self.ttkstyle.configure(
-                "TProgressbar",
-                text="%i/%i       " % (last, self.num_to_convert))
+            # rows done (including skipped and unchanged ones) and rows
+            # rendered, which alone take time:
+            progress, rendered = last
+            self.progressbar["value"] = progress
+            text = "%i/%i" % (progress, self.num_to_convert)
+            elapsed = time.monotonic() - self.start_time
+            if elapsed > 0 and rendered:
+                rate = rendered / elapsed
+                eta = (self.num_to_convert - progress) / rate
+                text += "   %.1f rows/s   ETA %i:%02i:%02i" % (
+                    rate, eta // 3600, eta // 60 % 60, eta % 60)
+            self.ttkstyle.configure("TProgressbar", text=text + "       ")
 
     def stop(self):
+        # the conversion thread terminates the worker processes right
+        # away; `periodic_call` resets the button when it has finished:
         self.stop_thread.set()
-        self.thread1.join()
+        self.go_button["text"] = "Stopping..."
+        self.go_button.state(['disabled'])
 
     def run_conversion(self):
 
@@ -449,11 +569,24 @@ class Application(tk.Frame):
         # TODO do this check on <Focus_Out> of entry:
         if self.datafilename != dataf:
             # user changed file name without hitting enter, reload:
-            if not os.path.isfile(dataf):
+            # (URIs like sqlite:///file.db are checked when loading)
+            if not os.path.isfile(dataf) and ":" not in dataf[2:]:
                 messagebox.showerror(
                     "Error", 'Data file "%s" does not exist.' % dataf)
                 return
-            self.open_data_file(dataf, keep_selected_sheet=True)
+            # and continue when it is loaded:
+            self.open_data_file(
+                dataf, keep_selected_sheet=True,
+                on_loaded=self.run_conversion)
+            return
+        if self.loading:
+            messagebox.showinfo(
+                "Loading", "Please wait until the data file is loaded.")
+            return
+        if self.data is None:
+            messagebox.showerror(
+                "Error", 'Data file "%s" could not be loaded.' % dataf)
+            return
 
         skip_data = bool(self.skip_var.get())
         if skip_data:
@@ -479,18 +612,45 @@ class Application(tk.Frame):
                 "Please fill in a proper destination file name.")
             return
 
+        if self.combined_var.get() and not FormLetter._has_pypdf():
+            messagebox.showerror(
+                "Error",
+                "Writing all into one pdf-file needs the package pypdf. "
+                "Please install it, e.g. with 'pip install pypdf'.")
+            return
+
         destdir = self.dir_edt.get()
         if not destdir:
             messagebox.showerror(
                 "Error",
                 "Please fill in a proper destination folder.")
             return
-        if os.path.isfile(destdir):
+        archive = None
+        if self.archive_var.get():
+            # absolute, so that it has a parent folder to create, also if
+            # a relative destination like 'out' is given:
+            archive = os.path.abspath(destdir) + '.zip'
+            if os.path.isdir(archive):
+                messagebox.showerror(
+                    "Error",
+                    "Destination archive is an already existing folder.")
+                return
+            if os.path.exists(archive):
+                result = messagebox.askokcancel(
+                    "File exists",
+                    'Warning: Destination archive "%s" already exists. '
+                    'If you continue, it will be overwritten.' % archive)
+                if not result:
+                    # user chose 'cancel'
+                    return
+            elif not os.path.isdir(os.path.dirname(archive)):
+                os.makedirs(os.path.dirname(archive))
+        elif os.path.isfile(destdir):
             messagebox.showerror(
                 "Error",
                 "Destination folder is an already existing file.")
             return
-        if os.path.isdir(destdir):
+        elif os.path.isdir(destdir):
             result = messagebox.askokcancel(
                 "Directory exists",
                 "Warning: Destination directory already exists. "
@@ -502,9 +662,20 @@ class Application(tk.Frame):
             # create directory:
             os.makedirs(destdir)
 
+        try:
+            jobs = int(self.jobs_spinbox.get())
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            messagebox.showerror(
+                "Error",
+                "Please fill in a proper number of parallel processes.")
+            return
+
         indexes = self.get_indexes_to_convert()
         self.num_to_convert = len(indexes)
         self.progressbar["max"] = self.num_to_convert
+        self.start_time = time.monotonic()
 
         self.stop_thread.clear()
         self.thread1 = Thread(
@@ -512,13 +683,18 @@ class Application(tk.Frame):
             kwargs={
                 "templatefile": tempf,
                 "datafile": dataf,
+                "data": self.data,
                 "sheet": self.sheet_name,
                 "do_skip_data": skip_data,
                 "skip_data_column": skip_column,
                 "skip_data_value": skip_value,
                 "destfile_format": destfile_format,
                 "destdir": destdir,
-                "indexes": indexes})
+                "indexes": indexes,
+                "combined": bool(self.combined_var.get()),
+                "incremental": bool(self.incremental_var.get()),
+                "archive": archive,
+                "jobs": jobs})
         self.thread1.start()
         self.go_button["style"] = 'red.TButton'
         self.go_button["text"] = "Stop"
@@ -526,45 +702,118 @@ class Application(tk.Frame):
         self.periodic_call()
 
     def secondary_thread_loop(
-            self, templatefile, datafile, sheet,
+            self, templatefile, datafile, data, sheet,
             do_skip_data, skip_data_column, skip_data_value,
-            destfile_format, destdir, indexes):
+            destfile_format, destdir, indexes, combined=False,
+            incremental=False, archive=None, jobs=1):
         print('using template file: %s' % templatefile)
         print('using data file: %s' % datafile)
         if sheet is not None:
             print('using sheet name: %s' % sheet)
 
-        fl = FormLetter.FormLetter(templatefile, datafile, sheet)
-        # workaround: fix skip_data_column name:
+        # use the data loaded already instead of parsing the file again,
+        # but only keep the columns needed:
+        usecols = FormLetter.FormLetter.get_pattern_fields(destfile_format)
         if do_skip_data:
-            skip_data_column = skip_data_column.replace(" ", "_")
-            # another workaround: convert skip_data_value into proper type:
-            skip_data_dtype = fl.data[skip_data_column].dtype
-            skip_data_value = pd.np.array(
-                    [skip_data_value,]).astype(skip_data_dtype)[0]
+            usecols.append(skip_data_column)
+        fl = FormLetter.FormLetter(templatefile, data, usecols=usecols)
         total = len(indexes)
+        if do_skip_data:
+            # select the rows to convert at once, instead of checking
+            # every row:
+            try:
+                skip = fl.get_column_mask(skip_data_column, skip_data_value)
+            except ValueError as e:
+                print("ERROR: can not compare data column %s with %s: %s" % (
+                    skip_data_column, skip_data_value, e))
+                return
+            indexes = fl.select_rows(indexes, skip)
+            print("skipping %i of %i data rows" % (
+                total - len(indexes), total))
+
+        if archive is not None:
+            # the file names are the names in the archive:
+            print('writing into archive: %s' % archive)
+            if incremental:
+                print("incremental conversion is not possible with an "
+                      "archive, converting all")
+            destdir = ''
+            incremental = False
+        # write the files in the background while rendering:
+        fl.output = FormLetter.BackgroundWriter(
+            FormLetter.ArchiveWriter(archive) if archive else None)
+        try:
+            self.convert_rows(
+                fl, destfile_format, destdir, indexes, total, combined,
+                incremental, jobs)
+        finally:
+            fl.output.close()
+            for fname, error in fl.output.errors.items():
+                print("ERROR writing file %s: %s" % (fname, error))
+
+    def convert_rows(
+            self, fl, destfile_format, destdir, indexes, total, combined,
+            incremental, jobs=1):
+        """Convert the rows `indexes`, which are left of `total` rows
+        after skipping; the progress is counted over all. Puts tuples
+        (progress, rendered rows) into the queue, see `check_queue`.
+        """
+        skipped = total - len(indexes)
+        self.queue.put((skipped, 0))
+
+        if combined:
+            if not indexes:
+                print("nothing to convert")
+                return
+            fname = os.path.join(destdir, destfile_format)
+            print("processing %i data rows: file %s" % (len(indexes), fname))
 
-        for i, rownum in enumerate(indexes):
-            if self.stop_thread.is_set():
-                break
-            row = fl.get_data_row(rownum)
-            fname = os.path.join(
-                destdir, destfile_format.format(row=rownum+1, **row))
-            if do_skip_data and row[skip_data_column] == skip_data_value:
-                print("skipping %i/%i (data row %i): file %s" % (i+1, total, rownum + 1, fname))
-                time.sleep(0.001) # just in case we skip a lot
-                # communicate progress:
-                self.queue.put(i + 1)
-                continue
+            def on_progress(n):
+                if self.stop_thread.is_set():
+                    raise InterruptedError
+                self.queue.put((skipped + n, n))
 
-            print("processing %i/%i (data row %i): file %s" % (i+1, total, rownum + 1, fname))
-            fl.write_to_pdf(rownum, fname)
-            # communicate progress:
-            self.queue.put(i + 1)
+            try:
+                fl.write_all_to_pdf(indexes, fname, callback=on_progress)
+            except InterruptedError:
+                pass
+            return
+
+        manifest = fl.open_manifest(destdir) if incremental else None
+        # rows rendered (unchanged ones are not yielded by
+        # `iter_render_batch`):
+        done = 0
+
+        def get_progress():
+            unchanged = manifest.unchanged if manifest is not None else 0
+            return done + skipped + unchanged
+
+        # renders the rows in `jobs` worker processes; closing it
+        # terminates them:
+        results = fl.iter_render_batch(
+            indexes, destfile_format, jobs=jobs, destdir=destdir,
+            manifest=manifest, cancel=self.stop_thread)
+        try:
+            for rownum, fname, error in results:
+                done += 1
+                if error is None:
+                    print("processed %i/%i (data row %i): file %s" % (
+                        get_progress(), total, rownum + 1, fname))
+                else:
+                    print("ERROR in data row %i: file %s: %s" % (
+                        rownum + 1, fname, error))
+                # communicate progress:
+                self.queue.put((get_progress(), done))
+                if self.stop_thread.is_set():
+                    break
+        finally:
+            results.close()
 
     def leave(self):
         if self.thread1:
             self.stop()
+            # at most waits for a row rendered in the conversion thread:
+            self.thread1.join()
         self.master.destroy()
 
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP server rendering single letters on demand.
+
+The template is compiled, and the fonts and stylesheets are loaded, once
+in each worker process when the server starts, so a request only pays for
+filling the template and laying it out. Endpoints:
+
+    GET  /render?row=N[&locale=L]   PDF of data row N (start counting at 0)
+    POST /render[?locale=L]         PDF of the JSON object in the request
+                                    body, mapping column names to values
+    GET  /metrics                   request latency and stage timings (JSON)
+
+Example:
+
+    python FormLetter_server.py letter.html data.xlsx --port 8000 -j 4
+    curl -o letter.pdf 'http://127.0.0.1:8000/render?row=3'
+    curl -o letter.pdf -d '{"RN": 17, "Person": "Doe"}' \\
+        http://127.0.0.1:8000/render
+
+"""
+
+import sys, os
+import json
+import time
+import threading
+import argparse
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import FormLetter
+
+
+class ServerBusy(Exception):
+    pass
+
+
+def _init_worker(args, kwargs):
+    FormLetter._init_worker(args, kwargs)
+    # load the fonts and parse the stylesheets before the first request:
+    FormLetter._worker_formletter._init_weasyprint()
+
+def _ping():
+    return os.getpid()
+
+def _render_worker(record, row=None, locale=None):
+    fl = FormLetter._worker_formletter
+    events = []
+    fl.observers = [lambda *event: events.append(event)]
+    fl.current_row = row
+    # ad-hoc records need not have all fields, don't fill the missing
+    # ones with the values of the previous request:
+    fl.subdict = dict.fromkeys(fl.columns, "")
+    return fl.get_record_pdf(record, locale), events
+
+
+class RenderServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, formletter, jobs=None, max_pending=None):
+        """Create a HTTP server rendering the template of `formletter`.
+
+        :param address: tuple (host, port);
+        :param formletter: FormLetter;
+            Its data is used for the requests by row number, and its
+            template and options by the worker processes.
+        :param jobs: None or int;
+            Number of worker processes. If None (default), the number of
+            CPUs will be used.
+        :param max_pending: None or int;
+            Maximum number of requests being rendered or waiting for a
+            worker. Further requests are answered with status 503. If
+            None (default), twice the number of worker processes.
+
+        """
+        super().__init__(address, RequestHandler)
+        self.formletter = formletter
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.jobs
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        # the 'request' stage is the whole time of a render request, the
+        # other ones are reported by the workers, see `FormLetter`:
+        self.profiler = FormLetter.StageProfiler(max_samples=10000)
+        self.counters = dict(requests=0, rejected=0, errors=0, pending=0)
+        # guards the counters:
+        self._lock = threading.Lock()
+        # held while the worker processes are restarted, which takes a
+        # while, so the counters and metrics are not blocked meanwhile:
+        self._restart_lock = threading.Lock()
+        self.executor = None
+        self._start_executor()
+
+    def _start_executor(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.jobs, mp_context=FormLetter._get_mp_context(),
+            initializer=_init_worker,
+            initargs=(self.formletter._init_args,
+                      self.formletter._init_kwargs))
+        # start all workers now, so the first requests don't wait:
+        futures = [self.executor.submit(_ping) for i in range(self.jobs)]
+        for future in futures:
+            future.result()
+
+    def _count(self, counter, increment=1):
+        with self._lock:
+            self.counters[counter] += increment
+
+    def render(self, record, row=None, locale=None):
+        """Return the template, filled with `record`, as PDF file content,
+        rendered by a worker process.
+
+        :raises ServerBusy: if `max_pending` requests are pending already.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise ServerBusy()
+        self._count('pending')
+        try:
+            executor = self.executor
+            try:
+                pdf, events = executor.submit(
+                    _render_worker, record, row, locale).result()
+            except BrokenProcessPool:
+                # a worker died, e.g. killed because of its memory use:
+                with self._restart_lock:
+                    if self.executor is executor:
+                        executor.shutdown(wait=False)
+                        self._start_executor()
+                raise
+        finally:
+            self._count('pending', -1)
+            self._slots.release()
+        for event in events:
+            self.profiler(*event)
+        return pdf
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = dict(self.counters)
+        metrics.update(jobs=self.jobs, max_pending=self.max_pending,
+                       stages=self.profiler.get_summary())
+        return metrics
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    server_version = 'FormLetter'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/metrics':
+            self._send_json(200, self.server.get_metrics())
+        elif url.path == '/render':
+            try:
+                row = int(query['row'])
+            except (KeyError, ValueError):
+                self._send_json(400, dict(
+                    error="parameter 'row' missing or not a number"))
+                return
+            fl = self.server.formletter
+            number_of_rows = fl.get_number_of_rows()
+            if number_of_rows is None or not 0 <= row < number_of_rows:
+                self._send_json(404, dict(error="no data row %i" % row))
+                return
+            self._render(fl.get_data_row(row), row, query.get('locale'))
+        else:
+            self._send_json(404, dict(error="unknown path %s" % url.path))
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path != '/render':
+            self._send_json(404, dict(error="unknown path %s" % url.path))
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            record = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self._send_json(400, dict(error="invalid JSON: %s" % e))
+            return
+        if not isinstance(record, dict):
+            self._send_json(400, dict(error="JSON object expected"))
+            return
+        self._render(record, None, query.get('locale'))
+
+    def _render(self, record, row, locale):
+        server = self.server
+        server._count('requests')
+        start = time.perf_counter()
+        try:
+            pdf = server.render(record, row, locale)
+        except ServerBusy:
+            self._send_json(503, dict(error="too many pending requests"),
+                            {'Retry-After': '1'})
+            return
+        except Exception as e:
+            server._count('errors')
+            self._send_json(500, dict(error="%s: %s" % (
+                type(e).__name__, e)))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(pdf)))
+        self.end_headers()
+        self.wfile.write(pdf)
+        server.profiler('request', row, time.perf_counter() - start)
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Serve PDF files filled from a template over HTTP.")
+    parser.add_argument("templatefile", help="template file (.html)")
+    parser.add_argument("datafile", nargs="?", default=None,
+                        help="data file (.xlsx, .csv, ...) for the "
+                             "requests by row number")
+    parser.add_argument("sheet_name", nargs="?", default=None,
+                        help="sheet name (default: first sheet)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on (default: 8000)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number "
+                             "of CPUs)")
+    parser.add_argument("--max-pending", type=int, default=None,
+                        metavar="N",
+                        help="answer further requests with status 503 if "
+                             "N requests are pending (default: twice the "
+                             "number of worker processes)")
+    parser.add_argument("--locale", default=None,
+                        help="locale for the formatters in the template, "
+                             "e.g. de_DE")
+    args = parser.parse_args(argv)
+
+    fl = FormLetter.FormLetter(
+        args.templatefile, args.datafile, args.sheet_name,
+        locale=args.locale, usecols=[])
+    server = RenderServer((args.host, args.port), fl, args.jobs,
+                          args.max_pending)
+    print('serving %s on http://%s:%i with %i worker processes' % (
+        args.templatefile, args.host, server.server_address[1], server.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
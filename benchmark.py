@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for FormLetter, using synthetic templates and data files.
+
+usage: python benchmark.py [--rows N] [--batch-sizes 1 50]
+       python benchmark.py --import-time [--max-import-time SECONDS]
+       python benchmark.py --suite [--sizes 100 10000 100000]
+                           [--output results.json]
+
+The suite renders a plain letter, a table-heavy invoice and an
+image-heavy flyer, with data from .csv and .xlsx files of different
+sizes. Each case runs in its own process, so its peak memory use can be
+measured. The results are printed and can be written as JSON, to
+compare different versions of FormLetter.
+
+"""
+import os.path
+import sys, os
+import argparse
+import importlib
+import subprocess
+import tempfile
+import time
+import json
+import platform
+import struct
+import zlib
+import FormLetter
+
+
+LETTER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+@page { size: A4; margin: 2cm; }
+body { font-family: sans-serif; font-size: 11pt; }
+.address { margin-bottom: 2cm; }
+.amount { font-weight: bold; }
+</style>
+</head>
+<body>
+<div class="address">{{ Person }}<br>{{ Street }}<br>{{ City }}</div>
+<p>Invoice number {{ RN }}</p>
+<p>Dear {{ Person }},</p>
+<p>please transfer the amount of
+<span class="amount">{{ Amount|format_amount }} EUR</span>
+until {{ Due }}.</p>
+<p>Kind regards</p>
+</body>
+</html>
+"""
+
+
+INVOICE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+@page { size: A4; margin: 1.5cm; }
+body { font-family: sans-serif; font-size: 9pt; }
+table { width: 100%; border-collapse: collapse; }
+th, td { border: 0.5pt solid #888; padding: 2pt 4pt; }
+td.number { text-align: right; }
+tr:nth-child(even) { background: #eee; }
+</style>
+</head>
+<body>
+<p>{{ Person }}<br>{{ Street }}<br>{{ City }}</p>
+<h1>Invoice {{ RN }}</h1>
+<table>
+<tr><th>Pos.</th><th>Item</th><th>Quantity</th><th>Price</th><th>Total</th></tr>
+{% for i in range(1, 61) %}
+<tr><td class="number">{{ i }}</td><td>Item {{ RN }}-{{ i }}</td>
+<td class="number">{{ i % 7 + 1 }}</td>
+<td class="number">{{ (Amount / 60)|format_amount }}</td>
+<td class="number">{{ (Amount / 60 * (i % 7 + 1))|format_amount }}</td></tr>
+{% endfor %}
+</table>
+<p>Please pay until {{ Due }}.</p>
+</body>
+</html>
+"""
+
+FLYER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+@page { size: A4; margin: 1cm; }
+body { font-family: sans-serif; }
+img { width: 8cm; height: 6cm; margin: 0.2cm; }
+</style>
+</head>
+<body>
+<h1>Special offers for {{ Person }}</h1>
+{% for i in range(8) %}<img src="image{{ i }}.png">{% endfor %}
+<p>Valid until {{ Due }} in {{ City }}.</p>
+</body>
+</html>
+"""
+
+TEMPLATES = {
+    "letter": LETTER_TEMPLATE,
+    "invoice": INVOICE_TEMPLATE,
+    "flyer": FLYER_TEMPLATE,
+}
+
+
+def write_letter_data(file_name, rows):
+    """Write a .csv file with `rows` rows of synthetic address data."""
+    with open(file_name, "w") as f:
+        f.write("RN,Person,Street,City,Amount,Due\n")
+        for i in range(rows):
+            f.write("%i,Person %i,Street %i,%05i City,%.2f,2020-12-%02i\n" % (
+                10000 + i, i, i % 200, i % 99999, (i * 37.13) % 5000,
+                i % 28 + 1))
+
+
+def write_png(file_name, width, height, color):
+    """Write a PNG image of a single `color` (tuple of r, g, b)."""
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+    raw = (b"\x00" + bytes(color) * width) * height
+    with open(file_name, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(
+            ">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
+
+
+def prepare_suite(directory, templates, sizes, formats):
+    """Write the templates, images and data files for the suite into
+    `directory`.
+
+    :returns:
+        list of dicts describing the cases, see `run_case`.
+    """
+    for name in templates:
+        with open(os.path.join(directory, name + ".html"), "w") as f:
+            f.write(TEMPLATES[name])
+    for i in range(8):
+        write_png(os.path.join(directory, "image%i.png" % i), 800, 600,
+                  (40 * i % 256, 255 - 30 * i, 128))
+    datafiles = {}
+    for size in sizes:
+        csv_name = os.path.join(directory, "data%i.csv" % size)
+        write_letter_data(csv_name, size)
+        datafiles[(size, ".csv")] = csv_name
+        if ".xlsx" in formats:
+            import pandas as pd
+            xlsx_name = os.path.join(directory, "data%i.xlsx" % size)
+            pd.read_csv(csv_name).to_excel(xlsx_name, index=False)
+            datafiles[(size, ".xlsx")] = xlsx_name
+    return [
+        {"template": os.path.join(directory, name + ".html"),
+         "template_name": name,
+         "datafile": datafiles[(size, ext)],
+         "format": ext, "rows": size}
+        for name in templates for ext in formats for size in sizes]
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes, or
+    None if unknown (e.g. on Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS:
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def bench_pdf(write, rows, directory):
+    """Call `write(row, file_name)` for `rows` rows and return a dict
+    with the rows/s and the total size of the written files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        for row in range(rows):
+            write(row, os.path.join(directory, "%06i.pdf" % row))
+        duration = time.perf_counter() - start
+    except Exception as e:
+        return {"error": "%s: %s" % (type(e).__name__, e)}
+    return {
+        "rows_per_s": rows / duration,
+        "output_bytes": sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory))}
+
+
+def run_case(case, html_rows, pdf_rows):
+    """Run one case of the suite and return a dict with the results.
+
+    :param case: dict with keys 'template', 'datafile' and further
+        keys which are copied to the results.
+    """
+    result = dict(case)
+    # not part of the load time:
+    for module in ("pandas", "jinja2"):
+        importlib.import_module(module)
+    # without the data cache, which would also write the cache file:
+    start = time.perf_counter()
+    fl = FormLetter.FormLetter(case["template"], case["datafile"],
+                               verbose=False, data_cache=False)
+    result["load_s"] = time.perf_counter() - start
+    # with a warm data cache, in the temporary directory of the suite
+    # instead of the user's cache directory:
+    cache_dir = os.path.join(os.path.dirname(case["template"]), "cache")
+    FormLetter.FormLetter(case["template"], case["datafile"],
+                          verbose=False, data_cache=cache_dir)
+    start = time.perf_counter()
+    FormLetter.FormLetter(case["template"], case["datafile"],
+                          verbose=False, data_cache=cache_dir)
+    result["load_cached_s"] = time.perf_counter() - start
+
+    rows = min(html_rows, fl.get_number_of_rows())
+    start = time.perf_counter()
+    for row in range(rows):
+        fl.get_filled_html(row)
+    result["html_rows_per_s"] = rows / (time.perf_counter() - start)
+
+    rows = min(pdf_rows, fl.get_number_of_rows())
+    outdir = os.path.join(
+        os.path.dirname(case["template"]),
+        "out_%s_%i%s" % (case["template_name"], case["rows"],
+                         case["format"]))
+    result["weasyprint"] = bench_pdf(
+        fl.write_to_pdf, rows, os.path.join(outdir, "weasyprint"))
+    result["xhtml2pdf"] = bench_pdf(
+        fl.write_to_pdf_xhtml2pdf, rows, os.path.join(outdir, "xhtml2pdf"))
+    result["peak_rss_bytes"] = get_peak_rss()
+    return result
+
+
+def run_suite(templates, sizes, formats, html_rows, pdf_rows):
+    """Run all cases of the suite, each in its own process.
+
+    :returns:
+        dict with information about the environment and a list of the
+        results of all cases.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for case in prepare_suite(tmpdir, templates, sizes, formats):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-case",
+                 json.dumps(case), "--html-rows", str(html_rows),
+                 "--pdf-rows", str(pdf_rows)],
+                stdout=subprocess.PIPE, universal_newlines=True)
+            if output.returncode != 0:
+                result = dict(case, error="exit code %i" % output.returncode)
+            else:
+                result = json.loads(output.stdout.strip().split("\n")[-1])
+            print_result(result)
+            results.append(result)
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "html_rows": html_rows,
+        "pdf_rows": pdf_rows,
+        "results": results,
+    }
+
+
+def print_result(result):
+    text = "%-8s %6s %7i rows:" % (
+        result["template_name"], result["format"], result["rows"])
+    if "error" in result:
+        print(text, "ERROR", result["error"])
+        return
+    text += " load %.2f s" % result["load_s"]
+    if "load_cached_s" in result:
+        text += " (cached %.2f s)" % result["load_cached_s"]
+    text += ", html %.0f rows/s" % result["html_rows_per_s"]
+    for renderer in ["weasyprint", "xhtml2pdf"]:
+        pdf = result[renderer]
+        if "error" in pdf:
+            text += ", %s failed" % renderer
+        else:
+            text += ", %s %.1f rows/s (%i bytes)" % (
+                renderer, pdf["rows_per_s"], pdf["output_bytes"])
+    if result["peak_rss_bytes"] is not None:
+        text += ", peak RSS %.0f MB" % (result["peak_rss_bytes"] / 2**20)
+    print(text)
+
+
+def bench_layout_batch_size(rows, batch_sizes):
+    """Compare the throughput of `FormLetter.render_batch` for different
+    values of `layout_batch_size`.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template = os.path.join(tmpdir, "letter.html")
+        with open(template, "w") as f:
+            f.write(LETTER_TEMPLATE)
+        datafile = os.path.join(tmpdir, "data.csv")
+        write_letter_data(datafile, rows)
+        fl = FormLetter.FormLetter(template, datafile, verbose=False,
+                                   data_cache=False)
+
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            results = fl.render_batch(
+                range(rows), "{row:06}.pdf", destdir=tmpdir,
+                layout_batch_size=batch_size)
+            duration = time.perf_counter() - start
+            errors = [error for _, _, error in results if error is not None]
+            if errors:
+                print("K=%i: %i errors, first: %s" % (
+                    batch_size, len(errors), errors[0]))
+            print("K=%i: %i rows in %.2f s, %.1f rows/s" % (
+                batch_size, rows, duration, rows / duration))
+
+
+# modules which must not be imported by `import FormLetter`:
+HEAVY_MODULES = ['pandas', 'jinja2', 'weasyprint', 'babel']
+
+
+def bench_import_time(max_time=None, repeat=5):
+    """Measure the time to import FormLetter and FormLetter_GUI in a fresh
+    interpreter, and check that no heavy module is imported with them.
+
+    :returns:
+        True if all checks passed.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    ok = True
+    for module in ["FormLetter", "FormLetter_GUI"]:
+        code = ("import sys, time; t = time.perf_counter(); import %s; "
+                "print(time.perf_counter() - t); "
+                "print(' '.join(m for m in %r if m in sys.modules))") % (
+                    module, HEAVY_MODULES)
+        times = []
+        for i in range(repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", code], cwd=directory, check=True,
+                stdout=subprocess.PIPE, universal_newlines=True).stdout
+            duration, heavy = (output.split("\n") + [""])[:2]
+            times.append(float(duration))
+        print("import %s: %.3f s (best of %i)" % (module, min(times), repeat))
+        if heavy.strip():
+            print("ERROR: import %s imports %s" % (module, heavy.strip()))
+            ok = False
+        if max_time is not None and min(times) > max_time:
+            print("ERROR: import %s takes longer than %.3f s" % (
+                module, max_time))
+            ok = False
+    return ok
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog="benchmark.py", description="Benchmarks for FormLetter.")
+    parser.add_argument("--rows", type=int, default=200,
+                        help="number of rows to render (default: 200)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 50],
+                        metavar="K",
+                        help="layout batch sizes to compare (default: 1 50)")
+    parser.add_argument("--import-time", action="store_true",
+                        help="measure the import time of FormLetter and "
+                             "check that heavy modules are loaded lazily")
+    parser.add_argument("--max-import-time", type=float, default=None,
+                        metavar="SECONDS",
+                        help="fail if an import takes longer than this")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the benchmark suite")
+    parser.add_argument("--templates", nargs="+", choices=sorted(TEMPLATES),
+                        default=["letter", "invoice", "flyer"],
+                        help="templates of the suite (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 10000, 100000], metavar="ROWS",
+                        help="data file sizes of the suite "
+                             "(default: 100 10000 100000)")
+    parser.add_argument("--formats", nargs="+", choices=[".csv", ".xlsx"],
+                        default=[".csv", ".xlsx"],
+                        help="data file formats of the suite (default: all)")
+    parser.add_argument("--html-rows", type=int, default=10000,
+                        help="maximum number of rows to fill the template "
+                             "with, per case (default: 10000)")
+    parser.add_argument("--pdf-rows", type=int, default=20,
+                        help="number of rows to render as PDF, per case "
+                             "and renderer (default: 20)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results of the suite as JSON")
+    parser.add_argument("--run-case", metavar="JSON", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.run_case:
+        print(json.dumps(run_case(
+            json.loads(args.run_case), args.html_rows, args.pdf_rows)))
+        return
+    if args.suite:
+        results = run_suite(args.templates, args.sizes, args.formats,
+                            args.html_rows, args.pdf_rows)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=1)
+        return
+    if args.import_time:
+        if not bench_import_time(args.max_import_time):
+            sys.exit(1)
+        return
+    bench_layout_batch_size(args.rows, args.batch_sizes)
+
+
+if __name__ == '__main__':
+    main()
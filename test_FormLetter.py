@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of FormLetter which need no WeasyPrint. Run with `python -m pytest`.
+"""
+import sys
+import datetime
+import decimal
+
+import pytest
+
+babel = pytest.importorskip('babel')
+import babel.numbers, babel.dates
+jinja2 = pytest.importorskip('jinja2')
+
+import FormLetter
+
+
+@pytest.fixture
+def formatters():
+    return FormLetter.Formatters('en_US')
+
+
+def render(formatters, source, **values):
+    env = jinja2.Environment()
+    env.filters.update(formatters.get_filters())
+    return env.from_string(source).render(**values)
+
+
+class TestFormatters(object):
+
+    def test_default_locale(self):
+        f = FormLetter.Formatters('de_DE')
+        assert f.format_decimal(1234.5) == '1.234,5'
+        assert f.format_amount(12.5) == '12,50'
+        assert f.format_currency(12.5, 'EUR') == babel.numbers.format_currency(
+            12.5, 'EUR', locale='de_DE')
+
+    def test_currency_locale(self, formatters):
+        expected = babel.numbers.format_currency(12.5, 'EUR', locale='de_DE')
+        assert formatters.format_currency(
+            12.5, 'EUR', locale='de_DE') == expected
+        assert formatters.format_currency(
+            12.5, 'EUR', None, 'de_DE') == expected
+        # the cache must not mix up locales:
+        assert formatters.format_currency(12.5, 'EUR') == (
+            babel.numbers.format_currency(12.5, 'EUR', locale='en_US'))
+
+    def test_currency_extra_arguments(self, formatters):
+        assert formatters.format_currency(
+            12.5, 'EUR', None, 'de_DE', False, 'name') == (
+                babel.numbers.format_currency(
+                    12.5, 'EUR', None, 'de_DE', False, 'name'))
+        assert formatters.format_currency(
+            12.5, 'EUR', format_type='name') == (
+                babel.numbers.format_currency(
+                    12.5, 'EUR', format_type='name', locale='en_US'))
+
+    def test_decimal_and_percent_locale(self, formatters):
+        assert formatters.format_decimal(1234.5, '#,##0', 'de_DE') == '1.234'
+        assert formatters.format_decimal(
+            1234.5, '#,##0', locale='de_DE') == '1.234'
+        assert formatters.format_decimal(1234.5, '#,##0') == '1,234'
+        assert formatters.format_percent(0.25, locale='fr_FR') == (
+            babel.numbers.format_percent(0.25, locale='fr_FR'))
+        assert formatters.format_amount(1234.5, locale='de_DE') == '1.234,50'
+
+    def test_date_locale(self, formatters):
+        date = datetime.date(2021, 3, 14)
+        for format in ('long', 'short', 'dd.MM.yyyy'):
+            for locale in ('de_DE', 'en_US', 'fr_FR'):
+                assert formatters.format_date(
+                    date, format, locale=locale) == (
+                        babel.dates.format_date(date, format, locale=locale))
+                assert formatters.format_date(date, format, locale) == (
+                    babel.dates.format_date(date, format, locale=locale))
+        assert formatters.format_date(date) == babel.dates.format_date(
+            date, locale='en_US')
+
+    def test_datetime_locale(self, formatters):
+        value = datetime.datetime(2021, 3, 14, 15, 9, 26)
+        assert formatters.format_datetime(value, 'long', None, 'de_DE') == (
+            babel.dates.format_datetime(value, 'long', locale='de_DE'))
+        assert formatters.format_datetime(value, locale='de_DE') == (
+            babel.dates.format_datetime(value, locale='de_DE'))
+
+    def test_unhashable_value(self, formatters):
+        class Unhashable(float):
+            __hash__ = None
+        assert formatters.format_decimal(
+            Unhashable(1.5), locale='de_DE') == '1,5'
+        assert formatters.format_decimal(
+            decimal.Decimal('1.5'), locale='de_DE') == '1,5'
+
+    def test_errors_not_repeated(self, formatters):
+        calls = []
+
+        def fail(value, *args, **kwargs):
+            calls.append(value)
+            raise TypeError("not a number")
+        formatters.get_locales()
+        for value in (1.5, [1.5]):
+            with pytest.raises(TypeError):
+                formatters._format(fail, value, (), {})
+        assert calls == [1.5, [1.5]]
+
+    def test_template_filters(self, formatters):
+        assert render(
+            formatters, "{{ x|format_currency('EUR', locale='de_DE') }}",
+            x=12.5) == babel.numbers.format_currency(
+                12.5, 'EUR', locale='de_DE')
+        assert render(
+            formatters, "{{ d|format_date(locale='de_DE') }}",
+            d=datetime.date(2021, 3, 14)) == babel.dates.format_date(
+                datetime.date(2021, 3, 14), locale='de_DE')
+        assert render(
+            formatters, "{{ x|format_decimal('#,##0', 'de_DE') }}",
+            x=1234.5) == '1.234'
+        assert render(formatters, "{{ x|format_amount }}", x=3) == '3.00'
+
+
+@pytest.fixture
+def template(tmp_path):
+    file_name = tmp_path / 'letter.html'
+    file_name.write_text(
+        '<html><body>{{ Person }}: {{ Amount|format_amount }}</body></html>')
+    return str(file_name)
+
+
+class TestManifest(object):
+
+    def test_template_hash_depends_on_locale(self, template):
+        hashes = {locale: FormLetter.FormLetter(
+                      template, None, locale=locale).get_template_hash()
+                  for locale in ('de_DE', 'en_US')}
+        assert hashes['de_DE'] != hashes['en_US']
+        assert hashes['de_DE'] == FormLetter.FormLetter(
+            template, None, locale='de_DE').get_template_hash()
+
+    def test_locale_change_renders_again(self, template, tmp_path):
+        record = {'Person': 'A', 'Amount': 12.5}
+        output = tmp_path / 'out.pdf'
+        output.write_bytes(b'%PDF')
+        fl = FormLetter.FormLetter(template, None, locale='de_DE')
+        manifest = fl.open_manifest(str(tmp_path))
+        assert not manifest.is_up_to_date(str(output), record)
+        manifest.add(str(output))
+        manifest.save()
+        assert fl.open_manifest(str(tmp_path)).is_up_to_date(
+            str(output), record)
+        fl = FormLetter.FormLetter(template, None, locale='en_US')
+        assert not fl.open_manifest(str(tmp_path)).is_up_to_date(
+            str(output), record)
+
+    def test_settings(self, template, tmp_path):
+        record = {'Person': 'A', 'Amount': 12.5}
+        manifest = FormLetter.FormLetter(template, None).open_manifest(
+            str(tmp_path))
+        assert manifest.get_input_hash(record, {'layout_batch_size': 1}) != (
+            manifest.get_input_hash(record, {'layout_batch_size': 4}))
+
+
+class TestEmptyRows(object):
+    """The rows (and thus the row numbers) must not depend on the loaded
+    columns, the data cache or streaming mode.
+    """
+
+    @pytest.fixture
+    def data(self):
+        pd = pytest.importorskip('pandas')
+        # row 1 is only empty in the columns used by the template, row 3
+        # is empty in all columns:
+        return pd.DataFrame({
+            'Person': ['A', None, 'C', None, 'E'],
+            'Amount': [1.5, None, 3.0, None, 5.0],
+            'Note': ['x', 'only note', 'z', None, 'w']})
+
+    def write(self, data, tmp_path, extension):
+        file_name = str(tmp_path / ('data' + extension))
+        if extension == '.csv':
+            data.to_csv(file_name, index=False)
+        elif extension == '.xlsx':
+            pytest.importorskip('openpyxl')
+            data.to_excel(file_name, index=False)
+        elif extension == '.parquet':
+            pytest.importorskip('pyarrow')
+            data.to_parquet(file_name)
+        elif extension == '.feather':
+            pytest.importorskip('pyarrow')
+            data.to_feather(file_name)
+        elif extension == '.db':
+            import sqlite3
+            with sqlite3.connect(file_name) as con:
+                data.to_sql('letters', con, index=False)
+            con.close()
+        return file_name
+
+    @pytest.mark.parametrize(
+        'extension', ['.csv', '.xlsx', '.parquet', '.feather', '.db'])
+    def test_rows_independent_of_columns(
+            self, data, template, tmp_path, extension):
+        file_name = self.write(data, tmp_path, extension)
+        cache = str(tmp_path / 'cache')
+        persons = []
+        for kwargs in (dict(usecols=None, data_cache=False),
+                       dict(usecols=[], data_cache=False),
+                       dict(usecols=[], data_cache=cache),
+                       dict(usecols=[], data_cache=cache),
+                       dict(usecols=[], chunksize=2)):
+            fl = FormLetter.FormLetter(
+                template, file_name, verbose=False, bytecode_cache=False,
+                **kwargs)
+            if kwargs['usecols'] is not None:
+                assert 'Note' not in fl.columns
+            persons.append([record['Person']
+                            for row, record in fl.iter_records()])
+        assert len(persons[0]) == 4
+        for other in persons[1:]:
+            assert [p if isinstance(p, str) else None for p in other] == [
+                p if isinstance(p, str) else None for p in persons[0]]
+
+    def test_parquet_without_empty_rows(self, data, template, tmp_path):
+        # the 'Note' column has no missing values, so the statistics tell
+        # that no row can be empty:
+        data = data.fillna({'Note': ''})
+        file_name = self.write(data, tmp_path, '.parquet')
+        source = FormLetter.get_data_source(file_name)
+        assert not source._has_empty_rows()
+        fl = FormLetter.FormLetter(
+            template, file_name, usecols=[], verbose=False,
+            bytecode_cache=False)
+        assert fl.get_number_of_rows() == 5
+
+
+class TestChunkTypes(object):
+    """In streaming mode all chunks must have the same column types, the
+    ones the whole column has when loaded.
+    """
+
+    @pytest.mark.parametrize(
+        'extension', ['.csv', '.xlsx', '.parquet', '.feather', '.db'])
+    def test_streaming_like_loaded(self, template, tmp_path, extension):
+        pd = pytest.importorskip('pandas')
+        # the first chunk has only integers in 'Amount' and 'Code', the
+        # second a missing amount and a code which is text:
+        data = pd.DataFrame({
+            'Person': ['A', 'B', 'C', 'D'],
+            'Amount': [1, 2, 3, None],
+            'Code': [10, 20, 'x', 40]})
+        if extension == '.csv':
+            # written by hand, pandas would write the amounts as floats:
+            file_name = str(tmp_path / 'data.csv')
+            with open(file_name, 'w') as f:
+                f.write('Person,Amount,Code\nA,1,10\nB,2,20\nC,3,x\nD,,40\n')
+        else:
+            data['Code'] = data['Code'].astype(str)
+            file_name = TestEmptyRows().write(data, tmp_path, extension)
+        records = []
+        for chunksize in (None, 2):
+            fl = FormLetter.FormLetter(
+                template, file_name, verbose=False, bytecode_cache=False,
+                data_cache=False, chunksize=chunksize)
+            records.append([dict(record) for row, record in fl.iter_records()])
+        assert [r['Amount'] for r in records[1]][:3] == [1.0, 2.0, 3.0]
+        assert [str(r['Amount']) for r in records[1]] == [
+            str(r['Amount']) for r in records[0]]
+        assert [str(r['Code']) for r in records[1]] == [
+            str(r['Code']) for r in records[0]]
+
+    def test_common_dtype(self):
+        np = pytest.importorskip('numpy')
+        common = FormLetter._get_common_dtype
+        assert common(np.dtype('int64'), np.dtype('float64')) == 'float64'
+        assert common(np.dtype('int64'), np.dtype('int64')) == 'int64'
+        assert common(np.dtype('float64'), np.dtype(object)) == object
+        assert common(np.dtype(bool), np.dtype('float64')) == object
+
+
+class TestPrecompiledStylesheets(object):
+
+    def test_keeps_cascade(self):
+        keeps = FormLetter.FormLetter._keeps_cascade
+        assert keeps('<html><body style="color: red">x</body></html>', False)
+        assert keeps(
+            '<html><body style="color: red !important">x</body></html>',
+            False)
+        # user !important would win against inline author !important:
+        assert not keeps(
+            '<html><body style="color: red !important">x</body></html>',
+            True)
+        assert keeps('<html><body style="color: red">x</body></html>', True)
+        # remaining author stylesheets would win against user ones:
+        assert not keeps(
+            '<html><head><style>p {color: {{ c }}}</style></head></html>',
+            False)
+        assert not keeps(
+            '<html><head><link rel="stylesheet" href="a.css"></head></html>',
+            False)
+        assert keeps(
+            '<html><head><link rel="icon" href="a.png"></head></html>', False)
+
+    def test_document_order(self, tmp_path, monkeypatch):
+        import types
+
+        class CSS(object):
+            def __init__(self, string=None, url=None, **kwargs):
+                self.source = string or url
+        monkeypatch.setitem(
+            sys.modules, 'weasyprint', types.SimpleNamespace(CSS=CSS))
+        (tmp_path / 'base.css').write_text('p { color: blue }')
+        template = tmp_path / 'letter.html'
+        template.write_text(
+            '<html><head><link rel="stylesheet" href="base.css">'
+            '<style>p { color: red }</style>'
+            '<link rel="stylesheet" href="late.css"></head>'
+            '<body><p>{{ Person }}</p></body></html>')
+        fl = FormLetter.FormLetter(
+            str(template), None, verbose=False, bytecode_cache=False)
+        assert [css.source.rsplit('/', 1)[-1]
+                for tag, css, important in fl._compile_stylesheets()] == [
+                    'base.css', 'p { color: red }', 'late.css']
+
+    def test_might_be_important(self, tmp_path):
+        might_be_important = FormLetter.FormLetter._might_be_important
+        plain = tmp_path / 'plain.css'
+        plain.write_text('p { color: red }')
+        important = tmp_path / 'important.css'
+        important.write_text('p { color: red ! important }')
+        assert not might_be_important(plain.as_uri())
+        assert might_be_important(important.as_uri())
+        assert might_be_important('https://example.com/style.css')
+
+
+class TestBackgroundWriter(object):
+
+    def test_reports_writing(self, tmp_path):
+        events = []
+        writer = FormLetter.BackgroundWriter(
+            threads=2, observers=[lambda *event: events.append(event)])
+        with writer:
+            for i in range(3):
+                writer.write(str(tmp_path / ('%i.pdf' % i)), b'%PDF')
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            '0.pdf', '1.pdf', '2.pdf']
+        assert [stage for stage, row, seconds in events] == ['write_file'] * 3
+        assert all(row is None and seconds >= 0
+                   for stage, row, seconds in events)
+
+
+class TestRenderStream(object):
+
+    def collect(self, fl, **kwargs):
+        import asyncio
+
+        async def collect():
+            return [row async for row, pdf, error in fl.render_stream(
+                **kwargs)]
+        return asyncio.run(collect())
+
+    def test_arguments(self, template):
+        pd = pytest.importorskip('pandas')
+        fl = FormLetter.FormLetter(
+            template, pd.DataFrame({'Person': ['A', 'B'], 'Amount': [1, 2]}),
+            verbose=False, bytecode_cache=False)
+        # no PDFs without WeasyPrint, but every row must be yielded:
+        assert sorted(self.collect(fl, jobs=0)) == [0, 1]
+        with pytest.raises(ValueError):
+            self.collect(fl, max_in_flight=0)
+
+
+class TestProjection(object):
+    """Loading only some columns must give the same rows and values as
+    loading all of them, without parsing the others.
+    """
+
+    CSV = ('Person,Amount,Note\n'
+           'A,1.5,x\n'
+           ',,\n'
+           '\n'
+           'NA,,"only, note"\n'
+           '"C",3,"two\n\nlines"\n'
+           ',"",NULL\n'
+           'E,5,\n')
+
+    def test_na_values(self):
+        parsers = pytest.importorskip('pandas._libs.parsers')
+        assert FormLetter._na_values == parsers.STR_NA_VALUES
+
+    def test_csv_empty_rows(self, tmp_path):
+        file_name = tmp_path / 'data.csv'
+        file_name.write_text(self.CSV)
+        source = FormLetter.get_data_source(str(file_name))
+        assert source._find_empty_rows() == [
+            False, True, False, False, True, False]
+
+    def test_csv(self, tmp_path, monkeypatch):
+        pd = pytest.importorskip('pandas')
+        file_name = tmp_path / 'data.csv'
+        file_name.write_text(self.CSV)
+        source = FormLetter.get_data_source(str(file_name))
+        expected = source.read_nonempty()[['Person', 'Amount']]
+        calls = []
+        read_csv = pd.read_csv
+        monkeypatch.setattr(pd, 'read_csv', lambda *args, **kwargs: (
+            calls.append(kwargs) or read_csv(*args, **kwargs)))
+        data = source.read_nonempty(
+            usecols=lambda column: column != 'Note')
+        assert [kwargs['usecols'] is not None for kwargs in calls] == [True]
+        pd.testing.assert_frame_equal(data, expected)
+
+    def test_xlsx(self, tmp_path):
+        pd = pytest.importorskip('pandas')
+        openpyxl = pytest.importorskip('openpyxl')
+        file_name = str(tmp_path / 'data.xlsx')
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        for row in [['Person', 'Amount', 'Count', 'Due', 'Note'],
+                    ['A', 1.5, 1, datetime.datetime(2021, 3, 14), 'x'],
+                    [None, None, None, None, None],
+                    ['NA', None, None, None, 'only note'],
+                    ['C', 3, 2.0, None, None],
+                    [None, None, None, None, 'N/A'],
+                    ['E', None, 4, datetime.datetime(2021, 3, 15), None]]:
+            ws.append(row)
+        wb.save(file_name)
+        source = FormLetter.get_data_source(file_name)
+        columns = ['Person', 'Amount', 'Count', 'Due']
+        expected = source.read_nonempty()[columns].reset_index(drop=True)
+        data = source.read_nonempty(usecols=lambda column: column in columns)
+        pd.testing.assert_frame_equal(data.reset_index(drop=True), expected)
+        assert source.read_nonempty(usecols=lambda column: False).shape == (
+            4, 0)
+
+    def test_data_cache(self, tmp_path):
+        pytest.importorskip('pandas')
+        file_name = tmp_path / 'data.csv'
+        file_name.write_text(self.CSV)
+        source = FormLetter.get_data_source(str(file_name))
+        cache = FormLetter.DataCache(str(tmp_path / 'cache'))
+        usecols = lambda column: column == 'Person'
+        data = FormLetter.load_data(source, usecols=usecols, data_cache=cache)
+        assert list(data.columns) == ['Person']
+        assert len(list((tmp_path / 'cache').iterdir())) == 1
+        assert cache.get(source, columns=['Person']).equals(data)
+        # the columns are taken from the whole sheet if that is cached:
+        FormLetter.load_data(source, data_cache=cache)
+        assert cache.get(source, columns=['Amount']).shape == (4, 1)
+
+
+class TestCombinedPdf(object):
+
+    def test_needs_pypdf(self, template, tmp_path, monkeypatch):
+        pd = pytest.importorskip('pandas')
+        monkeypatch.setitem(sys.modules, 'pypdf', None)
+        fl = FormLetter.FormLetter(
+            template, pd.DataFrame({'Person': ['A'], 'Amount': [1]}),
+            verbose=False, bytecode_cache=False)
+        with pytest.raises(ImportError, match='pypdf'):
+            fl.write_all_to_pdf(None, str(tmp_path / 'all.pdf'))
+        assert not (tmp_path / 'all.pdf').exists()